@@ -32,6 +32,19 @@ except NameError:
     from urllib.parse import urlparse, quote
     from urllib.request  import urlopen
 
+try:
+    # Python 2
+    import Queue as queue
+except ImportError:
+    # Python 3
+    import queue
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
 import traceback
 import sys
 import re
@@ -47,7 +60,11 @@ import ctypes
 from itertools import chain, repeat
 import time
 import zipfile
+import tarfile
 import argparse
+import threading
+import tempfile
+import fnmatch
 from random import randint
 from contextlib import contextmanager
 
@@ -107,6 +124,7 @@ ignores = [
 
     # Settings files
     ".mbed",
+    ".mbed_journal",
     "*.settings",
     "mbed_settings.py",
 
@@ -154,14 +172,33 @@ install_requirements = True
 cache_repositories = True
 
 mbed_app_file_name = "mbed_app.json"
+lock_file_name = "mbed.lock"
+
+# number of parallel jobs for multi-repository operations
+default_jobs = 1
+# number of parallel jobs for read-only queries (ls, status, releases)
+default_query_jobs = 8
+# initial and maximum number of concurrent network operations per host
+default_host_jobs = 4
+max_host_jobs = 16
+# number of retries of failed network operations
+default_retries = 2
+
+# how repositories cloned from the cache mirrors get their objects: hardlinked, borrowed from
+# the mirror (git alternates) or borrowed during the clone and copied afterwards
+cache_modes = ['copy', 'share', 'dissociate']
 
 # stores current working directory for recursive operations
 cwd_root = ""
 _cwd = os.getcwd()
+# per-thread state (working directory and work queue) of parallel workers
+_thread_state = threading.local()
+_log_lock = threading.Lock()
 
 # Logging and output
 def log(msg, is_error=False):
-    sys.stderr.write(msg) if is_error else sys.stdout.write(msg)
+    with _log_lock:
+        sys.stderr.write(msg) if is_error else sys.stdout.write(msg)
 
 def message(msg):
     if very_verbose:
@@ -186,11 +223,13 @@ def warning(msg):
     log("---\n", True)
 
 def error(msg, code=-1):
-    lines = msg.splitlines()
-    log(message("ERROR: %s" % lines.pop(0)), True)
-    for line in lines:
-        log("       %s\n" % line, True)
-    log("---\n", True)
+    task = getattr(_thread_state, 'task', None)
+    if not (task and task['killed']): # don't report failures caused by cancelling a parallel operation
+        lines = msg.splitlines()
+        log(message("ERROR: %s" % lines.pop(0)), True)
+        for line in lines:
+            log("       %s\n" % line, True)
+        log("---\n", True)
     sys.exit(code)
 
 def offline_warning(offline, top=True):
@@ -210,12 +249,14 @@ def progress_cursor():
 progress_spinner = progress_cursor()
 
 def progress():
+    if isworker():
+        return
     sys.stdout.write(next(progress_spinner))
     sys.stdout.flush()
     sys.stdout.write('\b')
 
 def show_progress(title, percent, max_width=80):
-    if sys.stdout.isatty():
+    if sys.stdout.isatty() and not isworker():
         percent = round(float(percent), 2)
         show_percent = '%.2f' % percent
         bwidth = max_width - len(str(title)) - len(show_percent) - 6 # 6 equals the spaces and paddings between title, progress bar and percentage
@@ -223,7 +264,7 @@ def show_progress(title, percent, max_width=80):
         sys.stdout.flush()
 
 def hide_progress(max_width=80):
-    if sys.stdout.isatty():
+    if sys.stdout.isatty() and not isworker():
         sys.stdout.write("\r%s\r" % (' ' * max_width))
 
 def create_default_mbed_app():
@@ -242,6 +283,10 @@ def popen(command, **kwargs):
     # print for debugging
     info("Exec \"%s\" in \"%s\"" % (' '.join(command), getcwd()))
     proc = None
+    if isworker():
+        kwargs.setdefault('cwd', getcwd())
+    if ssh_mux.isremote(command):
+        kwargs.setdefault('env', ssh_mux.env())
     try:
         proc = subprocess.Popen(command, **kwargs)
     except OSError as e:
@@ -252,13 +297,23 @@ def popen(command, **kwargs):
         else:
             raise e
 
-    if proc and proc.wait() != 0:
+    if proc:
+        WorkQueue.track(proc)
+        try:
+            proc.wait()
+        finally:
+            WorkQueue.untrack(proc)
+    if proc and proc.returncode != 0:
         raise ProcessException(proc.returncode, command[0], ' '.join(command), getcwd())
     return proc
 
 def pquery(command, output_callback=None, stdin=None, **kwargs):
     if very_verbose:
         info("Exec \"%s\" in \"%s\"" % (' '.join(command), getcwd()))
+    if isworker():
+        kwargs.setdefault('cwd', getcwd())
+    if ssh_mux.isremote(command):
+        kwargs.setdefault('env', ssh_mux.env())
     try:
         proc = subprocess.Popen(command, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
     except OSError as e:
@@ -269,21 +324,25 @@ def pquery(command, output_callback=None, stdin=None, **kwargs):
         else:
             raise e
 
-    if output_callback:
-        line = ""
-        while 1:
-            s = str(proc.stderr.read(1))
-            line += s
-            if s == '\r' or s == '\n':
-                output_callback(line, s)
-                line = ""
-
-            if proc.returncode is None:
-                proc.poll()
-            else:
-                break
+    WorkQueue.track(proc)
+    try:
+        if output_callback:
+            line = ""
+            while 1:
+                s = str(proc.stderr.read(1))
+                line += s
+                if s == '\r' or s == '\n':
+                    output_callback(line, s)
+                    line = ""
+
+                if proc.returncode is None:
+                    proc.poll()
+                else:
+                    break
 
-    stdout, _ = proc.communicate(stdin)
+        stdout, _ = proc.communicate(stdin)
+    finally:
+        WorkQueue.untrack(proc)
 
     if very_verbose:
         log(stdout.decode(sys.getfilesystemencoding()).strip() + "\n")
@@ -293,6 +352,48 @@ def pquery(command, output_callback=None, stdin=None, **kwargs):
 
     return stdout.decode(sys.getfilesystemencoding())
 
+# Shares one SSH connection per host (OpenSSH ControlMaster) between the git commands
+# of this invocation that access remote repositories, so that clones, fetches and pushes
+# over ssh don't each pay the connection handshake. The connections are closed on exit.
+class SshMux(object):
+    commands = ['clone', 'fetch', 'pull', 'push', 'ls-remote']
+
+    def __init__(self):
+        self.dir = None
+        self.lock = threading.Lock()
+
+    def isremote(self, command):
+        return command[0] == git_cmd and len(command) > 1 and command[1] in self.commands
+
+    # Environment for git commands (None keeps the environment of mbed CLI)
+    def env(self):
+        # Keep the ssh command configured by the user. Windows OpenSSH doesn't support ControlMaster
+        if os.name == 'nt' or os.environ.get('GIT_SSH_COMMAND') or os.environ.get('GIT_SSH'):
+            return None
+        with self.lock:
+            if not self.dir:
+                # Unix socket paths are limited to about 100 characters
+                self.dir = tempfile.mkdtemp(prefix='mbed-ssh-', dir='/tmp' if os.path.isdir('/tmp') else None)
+        env = os.environ.copy()
+        env['GIT_SSH_COMMAND'] = 'ssh -o ControlMaster=auto -o ControlPersist=60 -o ControlPath="%s"' % os.path.join(self.dir, '%C')
+        return env
+
+    def close(self):
+        with self.lock:
+            if not self.dir:
+                return
+            for sock in os.listdir(self.dir):
+                try:
+                    subprocess.call(['ssh', '-O', 'exit', '-o', 'ControlPath=%s' % os.path.join(self.dir, sock), 'mbed'],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                except OSError:
+                    pass
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+ssh_mux = SshMux()
+
+
 def rmtree_readonly(directory):
     if os.path.islink(directory):
         os.remove(directory)
@@ -309,27 +410,317 @@ def sizeof_fmt(num, suffix='B'):
         num /= 1024.0
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
+# Parses sizes like "500M" or "10GB" (binary units, as printed by sizeof_fmt) to bytes
+def parse_size(size):
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', str(size), re.I)
+    if m:
+        return int(float(m.group(1)) * 1024 ** ['', 'K', 'M', 'G', 'T'].index(m.group(2).upper()))
+
+# Parses ages like "12h", "30d" or "2w" to seconds
+def parse_age(age):
+    m = re.match(r'^\s*(\d+)\s*([hdw])\s*$', str(age), re.I)
+    if m:
+        return int(m.group(1)) * {'h': 3600, 'd': 86400, 'w': 604800}[m.group(2).lower()]
+
+def dirsize(path):
+    size = 0
+    for dirpath, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:
+                pass
+    return size
+
 # Directory navigation
+# Worker threads share the process working directory, so they only track their
+# own directory and pass it explicitly to subprocesses and file operations
 @contextlib.contextmanager
 def cd(newdir):
     global _cwd
     prevdir = getcwd()
-    os.chdir(newdir)
-    _cwd = newdir
-    try:
-        yield
-    finally:
-        os.chdir(prevdir)
-        _cwd = prevdir
+    if isworker():
+        _thread_state.cwd = os.path.join(prevdir, newdir)
+        try:
+            yield
+        finally:
+            _thread_state.cwd = prevdir
+    else:
+        os.chdir(newdir)
+        _cwd = newdir
+        try:
+            yield
+        finally:
+            os.chdir(prevdir)
+            _cwd = prevdir
 
 def getcwd():
     global _cwd
-    return _cwd
+    return getattr(_thread_state, 'cwd', None) or _cwd
 
 def relpath(root, path):
     return path[len(root)+1:]
 
 
+# Parallel execution
+def isworker():
+    return getattr(_thread_state, 'queue', None) is not None
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+# Returns a lock shared by all threads for the specified key, e.g. a repository path
+def threadlock(*key):
+    with _thread_locks_lock:
+        if key not in _thread_locks:
+            _thread_locks[key] = threading.RLock()
+        return _thread_locks[key]
+
+# Holds an OS lock on the file path (shared or exclusive), which excludes other processes and
+# other threads alike as each holder opens the file. Waiters block in the kernel until it's released
+# Yields whether the lock was taken, which is always the case unless not waiting for it
+@contextmanager
+def filelock(path, shared=False, wait=True):
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), mode | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise e
+            if not wait:
+                yield False
+                return
+            info("Waiting for %s lock \"%s\"" % ('shared' if shared else 'exclusive', path))
+            fcntl.flock(f.fileno(), mode)
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+# Work queue executing tasks in a bounded pool of worker threads. Tasks may
+# queue more tasks, and run in the working directory they were queued from.
+# The first failure (or a task running longer than timeout seconds) cancels the
+# queue: queued tasks are dropped, the processes of running tasks are terminated
+# and the cleanups of the interrupted tasks are run. join() reports all failures.
+class WorkQueue(object):
+    def __init__(self, jobs, timeout=None):
+        self.jobs = max(int(jobs or 1), 1)
+        self.timeout = timeout if timeout is not None else gettimeout()
+        self.tasks = queue.Queue()
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.errors = []
+        self.running = {}
+        self.cancelled = False
+        self.threads = []
+
+    @classmethod
+    def current(cls):
+        return getattr(_thread_state, 'queue', None)
+
+    # Registers a cleanup, which runs if the current task fails or is cancelled
+    @classmethod
+    def cleanup(cls, func, *args):
+        task = getattr(_thread_state, 'task', None)
+        if task:
+            task['cleanups'].append((func, args))
+
+    # Tracks the processes of the current task, so they can be terminated on cancellation
+    @classmethod
+    def track(cls, proc):
+        work, task = cls.current(), getattr(_thread_state, 'task', None)
+        if work and task:
+            with work.cond:
+                task['path'] = getcwd()
+                task['procs'].append(proc)
+                if work.cancelled:
+                    task['killed'] = True
+                    terminate(proc)
+
+    @classmethod
+    def untrack(cls, proc):
+        work, task = cls.current(), getattr(_thread_state, 'task', None)
+        if work and task:
+            with work.cond:
+                task['procs'].remove(proc)
+
+    def put(self, func, *args, **kwargs):
+        with self.cond:
+            if self.cancelled:
+                return
+            self.pending += 1
+            if len(self.threads) < min(self.jobs, self.pending):
+                thread = threading.Thread(target=self.worker)
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+        self.tasks.put((getcwd(), func, args, kwargs))
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            for task in self.running.values():
+                task['killed'] = True
+                for proc in task['procs']:
+                    terminate(proc)
+
+    def worker(self):
+        _thread_state.queue = self
+        while True:
+            item = self.tasks.get()
+            if item is None:
+                break
+            path, func, args, kwargs = item
+            _thread_state.cwd = path
+            task = {'path': path, 'start': time.time(), 'procs': [], 'cleanups': [], 'killed': False}
+            try:
+                with self.cond:
+                    skip = self.cancelled
+                    if not skip:
+                        self.running[id(task)] = task
+                if not skip:
+                    _thread_state.task = task
+                    func(*args, **kwargs)
+            except BaseException as e: # error() raises SystemExit
+                _thread_state.task = None
+                for cleanup, cleanup_args in reversed(task['cleanups']):
+                    try:
+                        cleanup(*cleanup_args)
+                    except Exception:
+                        pass
+                with self.cond:
+                    # Failures caused by the cancellation itself aren't reported
+                    if not task['killed']:
+                        self.errors.append((task['path'], e))
+                self.cancel()
+            finally:
+                _thread_state.task = None
+                with self.cond:
+                    self.running.pop(id(task), None)
+                    self.pending -= 1
+                    self.cond.notify_all()
+
+    def wait(self):
+        # Wait with a timeout so the main thread still receives KeyboardInterrupt
+        with self.cond:
+            while self.pending:
+                self.cond.wait(0.1)
+                for task in list(self.running.values()):
+                    if self.timeout and not task['killed'] and time.time() - task['start'] > self.timeout:
+                        self.errors.append((task['path'], Exception("Timed out after %g seconds" % self.timeout)))
+                        self.cancel()
+
+    def join(self):
+        try:
+            self.wait()
+        except KeyboardInterrupt:
+            # Let the running tasks clean up after their processes are terminated
+            self.cancel()
+            self.wait()
+            raise
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+        if len(self.errors) == 1 and isinstance(self.errors[0][1], (ProcessException, SystemExit)):
+            raise self.errors[0][1]
+        elif self.errors:
+            failures = []
+            code = None
+            for path, e in self.errors:
+                if isinstance(e, ProcessException) and len(e.args) > 3:
+                    failures.append("\"%s\" returned error code %s in \"%s\"" % (e.args[2], e.args[0], e.args[3]))
+                    code = code or e.args[0]
+                elif isinstance(e, SystemExit):
+                    failures.append("Failed in \"%s\" (see above)" % path)
+                    code = code or e.code
+                else:
+                    failures.append("%s in \"%s\"" % (e or e.__class__.__name__, path))
+            error(failures[0] if len(failures) == 1 else "%d operations failed:\n%s" % (len(failures), "\n".join(failures)), code if isinstance(code, int) else 1)
+
+def terminate(proc):
+    try:
+        proc.terminate()
+    except OSError: # already finished
+        pass
+
+# Schedules network operations (clone, fetch, download) per host. The number of
+# concurrent operations on a host is adjusted AIMD-style: it grows by one after
+# as many successful operations as the current limit and is halved by a failure,
+# which is usually caused by the server throttling requests. Failed operations
+# are retried with exponential backoff.
+class Transfers(object):
+    def __init__(self):
+        self.hosts = {}
+        self.cond = threading.Condition()
+
+    @classmethod
+    def host(cls, url):
+        try:
+            return urlparse(formaturl(url, 'https')).hostname
+        except ValueError:
+            return None
+
+    # Holds one of the concurrent operation slots of the url host (nested operations
+    # of a thread, e.g. the fetch of a clone from the cache, use the slot it holds)
+    @contextmanager
+    def slot(self, url):
+        host = self.host(url)
+        if getattr(_thread_state, 'hosts', None) is None:
+            _thread_state.hosts = set()
+        held = _thread_state.hosts
+        if not host or host in held:
+            yield
+            return
+
+        with self.cond:
+            state = self.hosts.setdefault(host, {'limit': float(default_host_jobs), 'active': 0})
+            while state['active'] >= int(state['limit']):
+                self.cond.wait()
+            state['active'] += 1
+        held.add(host)
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            held.discard(host)
+            with self.cond:
+                state['active'] -= 1
+                if ok:
+                    state['limit'] = min(state['limit'] + 1.0 / int(state['limit']), max_host_jobs)
+                else:
+                    state['limit'] = max(state['limit'] / 2, 1.0)
+                self.cond.notify_all()
+
+    # Runs a network operation on url, retrying failures with backoff
+    def run(self, url, func, *args, **kwargs):
+        # Local repositories aren't retried, and nested operations are retried by the outer one
+        host = self.host(url)
+        if not host or host in getattr(_thread_state, 'hosts', ()):
+            return func(*args, **kwargs)
+
+        retries = getretries()
+        attempt = 0
+        while True:
+            try:
+                with self.slot(url):
+                    return func(*args, **kwargs)
+            except (ProcessException, IOError, OSError):
+                work = WorkQueue.current()
+                if attempt >= retries or (work and work.cancelled):
+                    raise
+            delay = 2 ** attempt * randint(500, 1500) / 1000.0
+            attempt += 1
+            info("Network operation on \"%s\" failed. Retrying in %.1f seconds (%d of %d)" % (host, delay, attempt, retries))
+            time.sleep(delay)
+
+transfers = Transfers()
+
+
 def staticclass(cls):
     for k, v in cls.__dict__.items():
         if hasattr(v, '__call__') and not k.startswith('__'):
@@ -362,14 +753,15 @@ class Bld(object):
 
     def cleanup():
         info("Cleaning up library build folder")
-        for fl in os.listdir('.'):
+        for fl in os.listdir(getcwd()):
             if not fl.startswith('.'):
+                fl = os.path.join(getcwd(), fl)
                 if os.path.isfile(fl):
                     os.remove(fl)
                 else:
                     shutil.rmtree(fl)
 
-    def clone(url, path=None, depth=None, protocol=None):
+    def clone(url, path=None, depth=None, protocol=None, rev=None, sparse=None):
         m = Bld.isvalidurl(url)
         if not m:
             raise ProcessException(1, "Not a library build URL")
@@ -387,34 +779,36 @@ class Bld(object):
             error(e.args[1], e.args[0])
 
     def fetch_rev(url, rev):
-        rev_file = os.path.join('.'+Bld.name, '.rev-' + rev + '.zip')
+        rev_file = os.path.join(getcwd(), '.'+Bld.name, '.rev-' + rev + '.zip')
         try:
             if not os.path.exists(rev_file):
                 action("Downloading library build \"%s\" (might take a while)" % rev)
-                inurl = urlopen(url)
-                with open(rev_file, 'wb') as outfd:
-                    data = None
-                    while data != '':
-                        # Download and write the data in 1 MB chunks
-                        data = inurl.read(1024 * 1024)
-                        outfd.write(data)
+                def download():
+                    inurl = urlopen(url)
+                    with open(rev_file, 'wb') as outfd:
+                        data = None
+                        while data != '':
+                            # Download and write the data in 1 MB chunks
+                            data = inurl.read(1024 * 1024)
+                            outfd.write(data)
+                transfers.run(url, download)
         except Exception:
             if os.path.isfile(rev_file):
                 os.remove(rev_file)
             raise Exception(128, "Download failed!\nPlease try again later.")
 
     def unpack_rev(rev):
-        rev_file = os.path.join('.'+Bld.name, '.rev-' + rev + '.zip')
+        rev_file = os.path.join(getcwd(), '.'+Bld.name, '.rev-' + rev + '.zip')
         try:
             with zipfile.ZipFile(rev_file) as zf:
                 action("Unpacking library build \"%s\" in \"%s\"" % (rev, getcwd()))
-                zf.extractall('.')
+                zf.extractall(getcwd())
         except:
             if os.path.isfile(rev_file):
                 os.remove(rev_file)
             raise Exception(128, "An error occurred while unpacking library archive \"%s\" in \"%s\"" % (rev_file, getcwd()))
 
-    def checkout(rev, clean=False):
+    def checkout(rev, clean=False, detach=False):
         url = Bld.geturl()
         m = Bld.isvalidurl(url)
         if not m:
@@ -447,10 +841,10 @@ class Bld(object):
 
     def seturl(url):
         info("Setting url to \"%s\" in %s" % (url, getcwd()))
-        if not os.path.exists('.'+Bld.name):
-            os.mkdir('.'+Bld.name)
+        if not os.path.exists(os.path.join(getcwd(), '.'+Bld.name)):
+            os.mkdir(os.path.join(getcwd(), '.'+Bld.name))
 
-        fl = os.path.join('.'+Bld.name, 'bldrc')
+        fl = os.path.join(getcwd(), '.'+Bld.name, 'bldrc')
         try:
             with open(fl, 'w') as f:
                 f.write(url)
@@ -458,13 +852,13 @@ class Bld(object):
             error("Unable to write bldrc file in \"%s\"" % fl, 1)
 
     def geturl():
-        with open(os.path.join('.bld', 'bldrc')) as f:
+        with open(os.path.join(getcwd(), '.bld', 'bldrc')) as f:
             url = f.read().strip()
         m = Bld.isvalidurl(url)
         return m.group(1)+'/builds' if m else ''
 
     def getrev():
-        with open(os.path.join('.bld', 'bldrc')) as f:
+        with open(os.path.join(getcwd(), '.bld', 'bldrc')) as f:
             url = f.read().strip()
 
         m = Bld.isvalidurl(url)
@@ -491,7 +885,7 @@ class Hg(object):
     def cleanup():
         return True
 
-    def clone(url, name=None, depth=None, protocol=None):
+    def clone(url, name=None, depth=None, protocol=None, rev=None, sparse=None):
         if verbose or very_verbose:
             popen([hg_cmd, 'clone', formaturl(url, protocol), name] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
         else:
@@ -518,28 +912,73 @@ class Hg(object):
     def publish(all_refs=None):
         popen([hg_cmd, 'push'] + (['--new-branch'] if all_refs else []) + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
 
-    def fetch():
+    def fetch(source=None):
+        if source:
+            info("Fetching revisions from local repository \"%s\" to \"%s\"" % (source, os.path.basename(getcwd())))
+            popen([hg_cmd, 'pull', source] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+            return
         info("Fetching revisions from remote repository to \"%s\"" % os.path.basename(getcwd()))
-        popen([hg_cmd, 'pull'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+        transfers.run(Hg.geturl(), popen, [hg_cmd, 'pull'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+
+    # Creates a cache mirror of the local repository source in the current directory (a repository without working copy)
+    def cache_init(source, url):
+        if not os.path.isdir(os.path.join(getcwd(), '.hg')):
+            popen([hg_cmd, 'init'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+        Hg.seturl(url)
+        Hg.cache_update(source)
+
+    # Pulls the new revisions of the local repository source into the cache mirror
+    def cache_update(source):
+        info("Updating cached repository \"%s\" from \"%s\"" % (getcwd(), source))
+        popen([hg_cmd, 'pull', source] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+
+    # Pulls the remote repository url, or the bundle source, into the cache mirror in the current directory
+    def cache_fetch(url, source=None, head=None):
+        info("Fetching \"%s\" to cached repository \"%s\"" % (source or url, getcwd()))
+        if not os.path.isdir(os.path.join(getcwd(), '.hg')):
+            popen([hg_cmd, 'init'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+        Hg.seturl(url)
+        popen([hg_cmd, 'pull', source or url] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+
+    # Writes all revisions of the cache mirror in the current directory to the bundle file
+    def cache_bundle(file):
+        popen([hg_cmd, 'bundle', '--all', file] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+
+    # Clones the cache mirror (or another local copy) in path to name (hardlinked)
+    def clone_cache(path, name, shared=False):
+        popen([hg_cmd, 'clone', '-U', path, name] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
 
     def discard():
         info("Discarding local changes in \"%s\"" % os.path.basename(getcwd()))
         popen([hg_cmd, 'update', '-C'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
 
-    def checkout(rev, clean=False, clean_files=False):
+    def checkout(rev, clean=False, clean_files=False, detach=False):
         info("Checkout \"%s\" in %s" % (rev if rev else "latest", os.path.basename(getcwd())))
         if clean_files:
             files = pquery([hg_cmd, 'status', '--no-status', '-ui']).splitlines()
             for f in files:
                 info("Remove untracked file \"%s\"" % f)
-                os.remove(f)
+                os.remove(os.path.join(getcwd(), f))
         popen([hg_cmd, 'update'] + (['-C'] if clean else []) + (['-r', rev] if rev else []) + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
 
     def update(rev=None, clean=False, clean_files=False, is_local=False):
-        if not is_local:
+        if not is_local and not Hg.hasrev(rev):
             Hg.fetch()
         Hg.checkout(rev, clean, clean_files)
 
+    # Checks whether a changeset hash is already in the local repository (branches and tags might move)
+    def hasrev(rev):
+        if not rev or not re.match(r'^([a-fA-F0-9]{6,40})$', rev):
+            return False
+        try:
+            return bool(pquery([hg_cmd, 'log', '-r', rev, '--template', '{node}']).strip())
+        except ProcessException:
+            return False
+
+    # Checks the integrity of the repository (e.g. after an interrupted clone)
+    def verify():
+        pquery([hg_cmd, 'verify', '-q'])
+
     def status():
         return pquery([hg_cmd, 'status'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
 
@@ -549,6 +988,11 @@ class Hg(object):
     def untracked():
         return pquery([hg_cmd, 'status', '--no-status', '-u']).splitlines()
 
+    # Contents of the library references (.lib/.bld files) at rev, without checking it out
+    def showlibs(rev):
+        files = [f for f in pquery([hg_cmd, 'files', '-r', rev]).splitlines() if f.endswith('.lib') or f.endswith('.bld')]
+        return dict((f, pquery([hg_cmd, 'cat', '-r', rev, f])) for f in files)
+
     def outgoing():
         try:
             pquery([hg_cmd, 'outgoing'])
@@ -560,7 +1004,7 @@ class Hg(object):
 
     def seturl(url):
         info("Setting url to \"%s\" in %s" % (url, getcwd()))
-        hgrc = os.path.join('.hg', 'hgrc')
+        hgrc = os.path.join(getcwd(), '.hg', 'hgrc')
         tagpaths = '[paths]'
         remote = 'default'
         lines = []
@@ -577,18 +1021,24 @@ class Hg(object):
             if m:
                 remote = m.group(1)
                 del lines[idx+1]
-            lines.insert(idx, remote+' = '+url)
+            lines.insert(idx+1, remote+' = '+url)
         else:
             lines.append(tagpaths)
             lines.append(remote+' = '+url)
 
+        try:
+            with open(hgrc, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+        except IOError:
+            error("Unable to write hgrc file in \"%s\"" % hgrc, 1)
+
     def geturl():
         tagpaths = '[paths]'
         default_url = ''
         url = ''
 
         try:
-            with open(os.path.join('.hg', 'hgrc')) as f:
+            with open(os.path.join(getcwd(), '.hg', 'hgrc')) as f:
                 lines = f.read().splitlines()
                 if tagpaths in lines:
                     idx = lines.index(tagpaths)
@@ -607,9 +1057,9 @@ class Hg(object):
         return formaturl(url or pquery([hg_cmd, 'paths', 'default']).strip())
 
     def getrev():
-        if os.path.isfile(os.path.join('.hg', 'dirstate')):
+        if os.path.isfile(os.path.join(getcwd(), '.hg', 'dirstate')):
             from io import open
-            with open(os.path.join('.hg', 'dirstate'), 'rb') as f:
+            with open(os.path.join(getcwd(), '.hg', 'dirstate'), 'rb') as f:
                 return "".join('{:02x}'.format(x) for x in bytearray(f.read(6)))
         else:
             return ""
@@ -631,7 +1081,7 @@ class Hg(object):
 
     def hgrc():
         hook = 'ignore.local = .hg/hgignore'
-        hgrc = os.path.join('.hg', 'hgrc')
+        hgrc = os.path.join(getcwd(), '.hg', 'hgrc')
         try:
             with open(hgrc) as f:
                 exists = hook in f.read().splitlines()
@@ -649,7 +1099,7 @@ class Hg(object):
     def ignores():
         Hg.hgrc()
         try:
-            with open(Hg.ignore_file, 'w') as f:
+            with open(os.path.join(getcwd(), Hg.ignore_file), 'w') as f:
                 f.write("syntax: glob\n"+'\n'.join(ignores)+'\n')
         except IOError:
             error("Unable to write ignore file in \"%s\"" % os.path.join(getcwd(), Hg.ignore_file), 1)
@@ -657,14 +1107,14 @@ class Hg(object):
     def ignore(dest):
         Hg.hgrc()
         try:
-            with open(Hg.ignore_file) as f:
+            with open(os.path.join(getcwd(), Hg.ignore_file)) as f:
                 exists = dest in f.read().splitlines()
         except IOError:
             exists = False
 
         if not exists:
             try:
-                with open(Hg.ignore_file, 'a') as f:
+                with open(os.path.join(getcwd(), Hg.ignore_file), 'a') as f:
                     f.write(dest + '\n')
             except IOError:
                 error("Unable to write ignore file in \"%s\"" % os.path.join(getcwd(), Hg.ignore_file), 1)
@@ -672,7 +1122,7 @@ class Hg(object):
     def unignore(dest):
         Hg.ignore_file = os.path.join('.hg', 'hgignore')
         try:
-            with open(Hg.ignore_file) as f:
+            with open(os.path.join(getcwd(), Hg.ignore_file)) as f:
                 lines = f.read().splitlines()
         except IOError:
             lines = []
@@ -680,7 +1130,7 @@ class Hg(object):
         if dest in lines:
             lines.remove(dest)
             try:
-                with open(Hg.ignore_file, 'w') as f:
+                with open(os.path.join(getcwd(), Hg.ignore_file), 'w') as f:
                     f.write('\n'.join(lines) + '\n')
             except IOError:
                 error("Unable to write ignore file in \"%s\"" % os.path.join(getcwd(), Hg.ignore_file), 1)
@@ -719,12 +1169,34 @@ class Git(object):
         for branch in branches: # delete all local branches so the new repo clone is not poluted
             pquery([git_cmd, 'branch', '-D', branch])
 
-    def clone(url, name=None, depth=None, protocol=None):
+    def clone(url, name=None, depth=None, protocol=None, rev=None, sparse=None):
+        # Partial clone for sparse checkouts, file contents are fetched on checkout
+        args = ['--filter=blob:none'] if sparse else []
+        if depth and rev and re.match(r'^[a-fA-F0-9]{40}$', rev):
+            # Fetch only the pinned commit, not the history of the default branch
+            try:
+                Git.init(name)
+                with cd(name):
+                    popen([git_cmd, 'remote', 'add', 'origin', formaturl(url, protocol)])
+                    Git.fetch_rev(rev, depth, args)
+                    if sparse:
+                        Git.sparse(sparse, rev)
+                    popen([git_cmd, 'checkout', rev] + ([] if very_verbose else ['-q']))
+                return
+            except ProcessException:
+                info("Unable to fetch revision \"%s\" directly. Cloning the default branch instead" % rev)
+                if os.path.isdir(name):
+                    rmtree_readonly(name)
+
+        args += (['--depth', depth] if depth else []) + (['--no-checkout'] if sparse else [])
         if verbose or very_verbose:
-            popen([git_cmd, 'clone', formaturl(url, protocol), name] + (['--depth', depth] if depth else []) + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+            popen([git_cmd, 'clone', formaturl(url, protocol), name] + args + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
         else:
-            pquery([git_cmd, 'clone', '--progress', formaturl(url, protocol), name] + (['--depth', depth] if depth else []), output_callback=Git.action_progress)
+            pquery([git_cmd, 'clone', '--progress', formaturl(url, protocol), name] + args, output_callback=Git.action_progress)
             hide_progress()
+        if sparse:
+            with cd(name):
+                Git.sparse(sparse)
 
     def add(dest):
         info("Adding reference "+dest)
@@ -758,9 +1230,160 @@ class Git(object):
                 if not branch:
                     error(err+"Working set is not on a branch.", 1)
 
-    def fetch():
+    def fetch(source=None):
+        if source:
+            # Mirror the remote branches and tags already fetched by another local copy
+            info("Fetching revisions from local repository \"%s\" to \"%s\"" % (source, os.path.basename(getcwd())))
+            popen([git_cmd, 'fetch', '--tags', '--force', source, '+refs/remotes/*:refs/remotes/*'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+            return
         info("Fetching revisions from remote repository to \"%s\"" % os.path.basename(getcwd()))
-        popen([git_cmd, 'fetch', '--all', '--tags', '--force'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+        transfers.run(Git.geturl(), popen, [git_cmd, 'fetch', '--all', '--tags', '--force'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+
+    # Creates (or converts a copy of a working repository to) a cache mirror of url in the current
+    # directory: a bare repository, which has the remote branches of the repositories cached in it as its own
+    def cache_prepare(url):
+        if not os.path.isdir(os.path.join(getcwd(), '.git')):
+            popen([git_cmd, 'init', '--bare', '.git'] + ([] if very_verbose else ['-q']))
+        pquery([git_cmd, 'config', 'core.bare', 'true'])
+        # Fetches mustn't prune objects that clones in "share" cache mode might borrow
+        pquery([git_cmd, 'config', 'gc.auto', '0'])
+        pquery([git_cmd, 'config', 'gc.pruneExpire', 'never'])
+        if not Git.getremotes():
+            pquery([git_cmd, 'remote', 'add', 'origin', url])
+
+    def cache_init(source, url):
+        Git.cache_prepare(url)
+        Git.cache_update(source)
+
+    # Links the pack files of the local repository source missing in the cache mirror (packs are
+    # immutable), so fetching them only has to transfer loose objects and update refs
+    def linkpacks(source):
+        src = os.path.join(source, '.git', 'objects', 'pack')
+        dst = os.path.join(getcwd(), '.git', 'objects', 'pack')
+        if not os.path.isdir(src) or not os.path.isdir(dst):
+            return
+        for name in sorted(os.listdir(src)):
+            m = re.match(r'^(pack-[0-9a-f]+)\.pack$', name)
+            if not m or not os.path.isfile(os.path.join(src, m.group(1)+'.idx')) or os.path.exists(os.path.join(dst, m.group(1)+'.idx')):
+                continue
+            if os.path.isfile(os.path.join(src, m.group(1)+'.promisor')):
+                # Objects of partial clones may refer to objects missing in them
+                continue
+            # The index is linked last, as git only uses packs with an index
+            for f in [m.group(1)+'.pack', m.group(1)+'.idx']:
+                try:
+                    os.link(os.path.join(src, f), os.path.join(dst, f))
+                except OSError:
+                    # e.g. another filesystem, or the pack was linked already
+                    if not os.path.exists(os.path.join(dst, f)):
+                        shutil.copy2(os.path.join(src, f), os.path.join(dst, 'tmp_'+f))
+                        os.rename(os.path.join(dst, 'tmp_'+f), os.path.join(dst, f))
+            info("Linked pack \"%s\" to the cache" % m.group(1))
+
+    # Fetches the new revisions, remote branches and tags of the local repository source into the cache mirror
+    def cache_update(source):
+        info("Updating cached repository \"%s\" from \"%s\"" % (getcwd(), source))
+        Git.linkpacks(source)
+        popen([git_cmd, 'fetch', '--tags', '--force', source, '+refs/remotes/origin/*:refs/heads/*'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+        try:
+            pquery([git_cmd, 'update-ref', '-d', 'refs/heads/HEAD']) # from refs/remotes/origin/HEAD
+            with cd(source):
+                head = pquery([git_cmd, 'symbolic-ref', 'refs/remotes/origin/HEAD']).strip()
+            pquery([git_cmd, 'symbolic-ref', 'HEAD', head.replace('refs/remotes/origin/', 'refs/heads/')])
+        except ProcessException:
+            pass
+
+    # Fetches the branches and tags of the remote repository url, or of the bundle source, into
+    # the cache mirror in the current directory. head is the default branch, if known
+    def cache_fetch(url, source=None, head=None):
+        info("Fetching \"%s\" to cached repository \"%s\"" % (source or url, getcwd()))
+        Git.cache_prepare(url)
+        popen([git_cmd, 'fetch', '--tags', '--force', source or url, '+refs/heads/*:refs/heads/*'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+        try:
+            if not head and not source:
+                m = re.search(r'^ref: (refs/heads/\S+)\s+HEAD$', pquery([git_cmd, 'ls-remote', '--symref', url, 'HEAD']), re.M)
+                head = m.group(1) if m else None
+            if head:
+                pquery([git_cmd, 'symbolic-ref', 'HEAD', head])
+        except ProcessException:
+            pass
+        try:
+            pquery([git_cmd, 'rev-parse', '--verify', '-q', 'HEAD'])
+        except ProcessException:
+            # The default branch is unknown (e.g. dumb http servers), so use any
+            branches = pquery([git_cmd, 'for-each-ref', '--format=%(refname)', 'refs/heads/']).split()
+            for ref in ['refs/heads/master', 'refs/heads/main'] + branches[:1]:
+                if ref in branches:
+                    pquery([git_cmd, 'symbolic-ref', 'HEAD', ref])
+                    break
+
+    # Writes the branches and tags of the cache mirror in the current directory to the bundle file,
+    # and returns its default branch
+    def cache_bundle(file):
+        popen([git_cmd, 'bundle', 'create', file, '--branches', '--tags'])
+        try:
+            return pquery([git_cmd, 'symbolic-ref', 'HEAD']).strip()
+        except ProcessException:
+            return None
+
+    # Clones the cache mirror (or another local copy) in path to name. Objects are hardlinked, or borrowed through alternates if shared
+    def clone_cache(path, name, shared=False):
+        popen([git_cmd, 'clone'] + (['--shared'] if shared else []) + [os.path.join(path, '.git'), name] + ([] if very_verbose else ['-q']))
+
+    # Copies the objects borrowed through alternates, so the repository no longer depends on them
+    def dissociate():
+        info("Copying shared objects to \"%s\"" % os.path.basename(getcwd()))
+        popen([git_cmd, 'repack', '-a', '-d'] + ([] if very_verbose else ['-q']))
+        os.remove(os.path.join(getcwd(), '.git', 'objects', 'info', 'alternates'))
+
+    # Fetches a single commit (server must allow fetching reachable commits by hash)
+    def fetch_rev(rev, depth=1, args=None):
+        info("Fetching revision \"%s\" from remote repository to \"%s\"" % (rev, os.path.basename(getcwd())))
+        transfers.run(Git.geturl(), popen, [git_cmd, 'fetch', '--depth', str(depth), 'origin', rev] + (args or []) + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
+
+    def issparse():
+        try:
+            return pquery([git_cmd, 'config', '--get', 'core.sparseCheckout']).strip() == 'true'
+        except ProcessException:
+            return False
+
+    # Limits the working tree to the target directories of mbed OS for target, or
+    # restores the full working tree if target is None
+    def sparse(target=None, rev='HEAD'):
+        patterns = None
+        if target:
+            try:
+                patterns = sparse_patterns(json.loads(pquery([git_cmd, 'show', '%s:targets/targets.json' % rev])), target)
+            except (ProcessException, ValueError):
+                pass
+            if patterns is None:
+                warning("Unable to find target \"%s\" in \"%s\". Checking out the directories of all targets." % (target, os.path.basename(getcwd())))
+        elif not Git.issparse():
+            return
+
+        info("%s sparse checkout of \"%s\"" % ("Updating" if patterns else "Disabling", os.path.basename(getcwd())))
+        with open(os.path.join(getcwd(), '.git', 'info', 'sparse-checkout'), 'w') as f:
+            f.write('\n'.join(patterns or ['/*']) + '\n')
+        popen([git_cmd, 'config', 'core.sparseCheckout', 'true'])
+        popen([git_cmd, 'read-tree', '-mu', rev])
+        if not patterns:
+            popen([git_cmd, 'config', 'core.sparseCheckout', 'false'])
+
+    def isshallow():
+        return os.path.isfile(os.path.join(getcwd(), '.git', 'shallow'))
+
+    # Partial clones (e.g. without file contents, see clone()) fetch missing objects from the promisor remote
+    def ispartial():
+        try:
+            return pquery([git_cmd, 'config', '--get', 'remote.origin.promisor']).strip() == 'true'
+        except ProcessException:
+            return False
+
+    # Fetches the complete revision history and tags of a shallow repository
+    def unshallow():
+        if Git.isshallow():
+            info("Fetching complete revision history to \"%s\"" % os.path.basename(getcwd()))
+            popen([git_cmd, 'fetch', '--unshallow', '--tags'] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
 
     def discard(clean_files=False):
         info("Discarding local changes in \"%s\"" % os.path.basename(getcwd()))
@@ -772,16 +1395,16 @@ class Git(object):
         info("Merging \"%s\" with \"%s\"" % (os.path.basename(getcwd()), dest))
         popen([git_cmd, 'merge', dest] + (['-v'] if very_verbose else ([] if verbose else ['-q'])))
 
-    def checkout(rev, clean=False):
+    def checkout(rev, clean=False, detach=False):
         if not rev:
             return
         info("Checkout \"%s\" in %s" % (rev, os.path.basename(getcwd())))
         branch = None
-        refs = Git.getbranches(rev)
+        refs = [] if detach else Git.getbranches(rev)
         for ref in refs: # re-associate with a local or remote branch (rev is the same)
             m = re.match(r'^(.*?)\/(.*?)$', ref)
             if m and m.group(2) != "HEAD": # matches origin/<branch> and isn't HEAD ref
-                if not os.path.exists(os.path.join('.git', 'refs', 'heads', m.group(2))): # okay only if local branch with that name doesn't exist (git will checkout the origin/<branch> in that case)
+                if not os.path.exists(os.path.join(getcwd(), '.git', 'refs', 'heads', m.group(2))): # okay only if local branch with that name doesn't exist (git will checkout the origin/<branch> in that case)
                     branch = m.group(2)
             elif ref != "HEAD":
                 branch = ref # matches local branch and isn't HEAD ref
@@ -795,8 +1418,16 @@ class Git(object):
             popen([git_cmd, 'checkout', rev] + (['-f'] if clean else []) + ([] if very_verbose else ['-q']))
 
     def update(rev=None, clean=False, clean_files=False, is_local=False):
-        if not is_local:
-            Git.fetch()
+        if not is_local and not Git.hasrev(rev):
+            fetched = False
+            if Git.isshallow() and re.match(r'^[a-fA-F0-9]{40}$', rev or ''):
+                try:
+                    Git.fetch_rev(rev)
+                    fetched = True
+                except ProcessException:
+                    pass
+            if not fetched:
+                Git.fetch()
         if clean:
             Git.discard(clean_files)
         if rev:
@@ -816,6 +1447,20 @@ class Git(object):
                 if not branch:
                     info(err+"\nThe working set is not on a branch.\nYou should switch to a branch or create a new one from the current revision.")
 
+    # Checks whether a commit hash is already in the local object store (branches and tags might move)
+    def hasrev(rev):
+        if not rev or not re.match(r'^([a-fA-F0-9]{6,40})$', rev):
+            return False
+        try:
+            pquery([git_cmd, 'cat-file', '-e', rev + '^{commit}'])
+            return True
+        except ProcessException:
+            return False
+
+    # Checks that all objects reachable from the refs are present (e.g. after an interrupted clone)
+    def verify():
+        pquery([git_cmd, 'fsck', '--connectivity-only', '--no-progress'])
+
     def status():
         return pquery([git_cmd, 'status', '-s'] + (['-v'] if very_verbose else []))
 
@@ -825,11 +1470,18 @@ class Git(object):
     def untracked():
         return pquery([git_cmd, 'ls-files', '--others', '--exclude-standard']).splitlines()
 
+    # Contents of the library references (.lib/.bld files) at rev, without checking it out
+    def showlibs(rev):
+        files = [f for f in pquery([git_cmd, 'ls-tree', '-r', '--name-only', rev]).splitlines() if f.endswith('.lib') or f.endswith('.bld')]
+        return dict((f, pquery([git_cmd, 'show', '%s:%s' % (rev, f)])) for f in files)
+
     def outgoing():
         # Get default remote
         remote = Git.getremote()
         if not remote:
             return -1
+        # Comparing with the remote branch requires the history
+        Git.unshallow()
         # Get current branch
         branch = Git.getbranch()
         if not branch:
@@ -889,7 +1541,24 @@ class Git(object):
         return formaturl(url)
 
     def getrev():
-        return pquery([git_cmd, 'rev-parse', 'HEAD']).strip()
+        # Read HEAD directly if possible, as this is called for every repository in the tree
+        rev = Git.readref('HEAD')
+        return rev or pquery([git_cmd, 'rev-parse', 'HEAD']).strip()
+
+    # Resolves a (symbolic) ref from the loose ref files. Returns None if git has to be asked
+    def readref(ref):
+        git_dir = os.path.join(getcwd(), '.git')
+        for _ in range(5):
+            try:
+                with open(os.path.join(git_dir, *ref.split('/'))) as f:
+                    value = f.read().strip()
+            except (IOError, OSError):
+                return None
+            m = re.match(r'^ref: (refs/.+)$', value)
+            if not m:
+                return value if re.match(r'^[a-f0-9]{40}$', value) else None
+            ref = m.group(1)
+        return None
 
     # Gets current branch or returns empty string if detached
     def getbranch(rev='HEAD'):
@@ -945,35 +1614,35 @@ class Git(object):
 
     def ignores():
         try:
-            ignore_file_parent_directory = os.path.dirname(Git.ignore_file)
+            ignore_file_parent_directory = os.path.join(getcwd(), os.path.dirname(Git.ignore_file))
             if not os.path.exists(ignore_file_parent_directory):
                 os.mkdir(ignore_file_parent_directory)
 
-            with open(Git.ignore_file, 'w') as f:
+            with open(os.path.join(getcwd(), Git.ignore_file), 'w') as f:
                 f.write('\n'.join(ignores)+'\n')
         except IOError:
             error("Unable to write ignore file in \"%s\"" % os.path.join(getcwd(), Git.ignore_file), 1)
 
     def ignore(dest):
         try:
-            with open(Git.ignore_file) as f:
+            with open(os.path.join(getcwd(), Git.ignore_file)) as f:
                 exists = dest in f.read().splitlines()
         except IOError:
             exists = False
 
         if not exists:
             try:
-                ignore_file_parent_directory = os.path.dirname(Git.ignore_file)
+                ignore_file_parent_directory = os.path.join(getcwd(), os.path.dirname(Git.ignore_file))
                 if not os.path.exists(ignore_file_parent_directory):
                     os.mkdir(ignore_file_parent_directory)
 
-                with open(Git.ignore_file, 'a') as f:
+                with open(os.path.join(getcwd(), Git.ignore_file), 'a') as f:
                     f.write(dest.replace("\\", "/") + '\n')
             except IOError:
                 error("Unable to write ignore file in \"%s\"" % os.path.join(getcwd(), Git.ignore_file), 1)
     def unignore(dest):
         try:
-            with open(Git.ignore_file) as f:
+            with open(os.path.join(getcwd(), Git.ignore_file)) as f:
                 lines = f.read().splitlines()
         except IOError:
             lines = []
@@ -981,11 +1650,11 @@ class Git(object):
         if dest in lines:
             lines.remove(dest)
             try:
-                ignore_file_parent_directory = os.path.dirname(Git.ignore_file)
+                ignore_file_parent_directory = os.path.join(getcwd(), os.path.dirname(Git.ignore_file))
                 if not os.path.exists(ignore_file_parent_directory):
                     os.mkdir(ignore_file_parent_directory)
 
-                with open(Git.ignore_file, 'w') as f:
+                with open(os.path.join(getcwd(), Git.ignore_file), 'w') as f:
                     f.write('\n'.join(lines) + '\n')
             except IOError:
                 error("Unable to write ignore file in \"%s\"" % os.path.join(getcwd(), Git.ignore_file), 1)
@@ -1245,7 +1914,7 @@ class Repo(object):
     def __getattr__(self, attr):
         if attr in ['geturl', 'getrev', 'add', 'remove', 'ignores', 'ignore', 'unignore',
                     'status', 'dirty', 'commit', 'outgoing', 'publish', 'checkout', 'update',
-                    'isdetached']:
+                    'isdetached', 'isshallow', 'ispartial', 'unshallow', 'hasrev', 'verify']:
             wrapper = self.__wrap_scm(attr)
             self.__dict__[attr] = wrapper
             return wrapper
@@ -1261,29 +1930,69 @@ class Repo(object):
         return self.scm.remove(dest, *args, **kwargs)
 
     def clone(self, url, path, rev=None, depth=None, protocol=None, offline=False, **kwargs):
+        # Clones of the same repository are serialized, so that they can reuse each other
+        with threadlock('clone', DepGraph.key(url)):
+            if offline:
+                return self._clone(url, path, rev, depth=depth, protocol=protocol, offline=offline, **kwargs)
+
+            # Failing with every SCM might be a transient failure (a failure with one of them is
+            # expected), so only this is retried and reduces the concurrency for the host. Urls
+            # without any evidence of their SCM might just not exist, so these aren't retried.
+            def clone():
+                if not self._clone(url, path, rev, depth=depth, protocol=protocol, offline=offline, **kwargs):
+                    raise ProcessException(1, "Unable to clone repository")
+                return True
+            try:
+                if self.scmhints(url):
+                    return transfers.run(url, clone)
+                with transfers.slot(url):
+                    return clone()
+            except ProcessException:
+                return False
+
+    def _clone(self, url, path, rev=None, depth=None, protocol=None, offline=False, **kwargs):
         # Sorted so repositories that match urls are attempted first
-        info("Trying to guess source control management tool. Supported SCMs: %s" % ', '.join([s.name for s in scms.values()]))
-        for scm in scms.values():
+        candidates = self.scmorder(url)
+        info("Trying to guess source control management tool. Trying SCMs in order: %s" % ', '.join([s.name for s in candidates]))
+        sparse = sparse_target(path)
+        mode = Global().cache_cfg()['mode']
+        for scm in candidates:
             main = True
-            cache = self.get_cache(url, scm.name)
+            # Prefer another local copy of the same repository (fetched once) over the cache
+            source = dep_graph.source(url, scm.name, os.path.abspath(path))
+            cache = None if source else self.get_cache(url, scm.name)
 
             # Try to clone with cache ref first
-            if cache and not os.path.isdir(path):
-                info("Found matching cached repository in \"%s\"" % cache)
+            if (source or cache) and not os.path.isdir(path):
+                if source:
+                    info("Found local copy of the repository in \"%s\"" % source)
+                else:
+                    info("Found matching cached repository in \"%s\"" % cache)
+                share = cache and mode != 'copy'
                 try:
                     if os.path.split(path)[0] and not os.path.isdir(os.path.split(path)[0]):
                         os.makedirs(os.path.split(path)[0])
 
-                    info("Carbon copy from \"%s\" to \"%s\"" % (cache, path))
-                    with self.cache_lock_held(url):
-                        shutil.copytree(cache, path)
+                    if source:
+                        # A local clone hardlinks the objects instead of copying them
+                        info("Cloning local copy \"%s\" to \"%s\"" % (source, path))
+                        scm.clone_cache(source, path)
+                        with cd(path):
+                            scm.fetch(source)
+                    else:
+                        # Only the clone itself (local, hardlinked or shared) needs the cache to be consistent
+                        info("Cloning cached repository \"%s\" to \"%s\"" % (cache, path))
+                        with self.cache_lock_held(url, shared=True):
+                            scm.clone_cache(cache, path, shared=share)
+                        # Last access time, to evict the least recently used mirrors first
+                        CacheIndex(self.cache).used(cache, url, scm.name, shared=mode == 'share')
 
                     #
                     # If no revision was specified, use the branch associated with the cache. In the
                     # github case this will be the default branch (IOTBTOOL-279)
                     #
                     if not rev:
-                        with cd(cache):
+                        with cd(source or cache):
                             branch = scm.getbranch()
                             if branch:
                                 rev = branch
@@ -1294,10 +2003,21 @@ class Repo(object):
                     with cd(path):
                         scm.seturl(formaturl(url, protocol))
                         scm.cleanup()
-                        info("Update cached copy from remote repository")
-                        scm.update(rev, True, is_local=offline)
+                        if source:
+                            try:
+                                scm.update(rev, True, is_local=True)
+                            except ProcessException:
+                                info("Update local copy from remote repository")
+                                scm.update(rev, True, is_local=offline)
+                        else:
+                            info("Update cached copy from remote repository")
+                            scm.update(rev, True, is_local=offline)
+                        if share and mode == 'dissociate' and hasattr(scm, 'dissociate'):
+                            scm.dissociate()
+                        if sparse and hasattr(scm, 'sparse'):
+                            scm.sparse(sparse)
                         main = False
-                except (ProcessException, IOError):
+                except (ProcessException, IOError, OSError):
                     info("Discarding cached repository")
                     if os.path.isdir(path):
                         rmtree_readonly(path)
@@ -1307,7 +2027,7 @@ class Repo(object):
                 if offline:
                     continue
                 try:
-                    scm.clone(url, path, depth=depth, protocol=protocol, **kwargs)
+                    scm.clone(url, path, depth=depth, protocol=protocol, rev=rev, sparse=sparse, **kwargs)
                 except ProcessException:
                     if os.path.isdir(path):
                         rmtree_readonly(path)
@@ -1317,8 +2037,13 @@ class Repo(object):
             self.url = url
             self.path = os.path.abspath(path)
             self.ignores()
-            with self.cache_lock_held(url):
+            with self.cache_update_held(url):
                 self.set_cache(url)
+            limit = Global().cache_cfg()['limit']
+            if self.cache and limit:
+                cache_gc(self.cache, limit, keep=self.url2cachedir(url))
+            dep_graph.mark(url, self.path, scm.name)
+            scm_memo.set(url, scm.name)
             return True
 
         if offline:
@@ -1328,6 +2053,47 @@ class Repo(object):
 
         return False
 
+    # Orders the SCMs to clone url with, most likely first: the SCM that cloned the URL before
+    # or is in the cache, the SCM indicated by the URL or local repository, the SCM that cloned
+    # other repositories from the host before, the SCM of known hosts, then git and the others
+    # Names of the SCMs that url likely uses, most likely first (empty without any evidence)
+    def scmhints(self, url):
+        url_scm, host_scm = scm_memo.get(url)
+        names = [url_scm] + [name for name in scms if self.get_cache(url, name)]
+        if Bld.isvalidurl(url):
+            names.append('bld')
+        m = re.search(r'\.(git|hg)/?$', url)
+        if m:
+            names.append(m.group(1))
+        if os.path.isdir(url):
+            names += [name for name in scms if os.path.isdir(os.path.join(url, '.'+name))]
+            if os.path.isfile(os.path.join(url, 'HEAD')) and os.path.isdir(os.path.join(url, 'objects')): # bare repository
+                names.append('git')
+        names.append(host_scm)
+        if Transfers.host(url) in public_scm_services:
+            names.append('git')
+        if re.match(regex_mbed_url, url):
+            names.append('hg') # mbed.org code repositories are Mercurial
+        return [name for name in names if name in scms]
+
+    def scmorder(self, url):
+        order = []
+        for name in self.scmhints(url) + ['git'] + list(scms): # git is the most common otherwise
+            if name in scms and scms[name] not in order:
+                order.append(scms[name])
+        return order
+
+    # Library references at rev (which must be available locally, in path if specified), like getlibs()
+    def getrevlibs(self, rev, path=None):
+        with cd(path or self.path):
+            refs = self.scm.showlibs(rev)
+        libs = []
+        for f, ref in sorted(refs.items()):
+            if [d for d in f.split('/') if d.startswith('.')]: # hidden, as in getlibs()
+                continue
+            libs.append(Repo.fromurl(ref.strip(), os.path.join(self.path, f[:-4])))
+        return libs
+
     def getlibs(self):
         for root, dirs, files in os.walk(self.path):
             dirs[:] = [d for d in dirs  if not d.startswith('.')]
@@ -1341,13 +2107,25 @@ class Repo(object):
                     if f[:-4] in dirs:
                         dirs.remove(f[:-4])
 
-    def write(self):
+    # URL as stored in library references and lock files
+    def refurl(self):
         up = urlparse(self.url)
         if up.hostname:
             url = up._replace(netloc=up.hostname + (':'+str(up.port) if up.port else '')).geturl() # strip auth string
         else:
             url = self.url # use local repo "urls" as is
 
+        if up.hostname in public_scm_services:
+            # Safely convert repo URL to https schema if this is a public SCM service (github/butbucket), supporting all schemas.
+            # This allows anonymous cloning of public repos without having to have ssh keys and associated accounts at github/bitbucket/etc.
+            # Without this anonymous users will get clone errors with ssh repository links even if the repository is public.
+            # See https://help.github.com/articles/which-remote-url-should-i-use/
+            url = formaturl(url, 'https')
+        return url
+
+    def write(self):
+        url = self.refurl()
+
         if os.path.isfile(self.lib):
             with open(self.lib) as f:
                 lib_repo = Repo.fromurl(f.read().strip())
@@ -1358,13 +2136,6 @@ class Repo(object):
                     #print self.name, 'unmodified'
                     return
 
-        if up.hostname in public_scm_services:
-            # Safely convert repo URL to https schema if this is a public SCM service (github/butbucket), supporting all schemas.
-            # This allows anonymous cloning of public repos without having to have ssh keys and associated accounts at github/bitbucket/etc.
-            # Without this anonymous users will get clone errors with ssh repository links even if the repository is public.
-            # See https://help.github.com/articles/which-remote-url-should-i-use/
-            url = formaturl(url, 'https')
-
         ref = url.rstrip('/') + '/' + (('' if self.is_build else '#') + self.rev if self.rev else '')
         action("Updating reference \"%s\" -> \"%s\"" % (relpath(cwd_root, self.path) if cwd_root != self.path else self.name, ref))
         with open(self.lib, 'w') as f:
@@ -1373,9 +2144,9 @@ class Repo(object):
     def rm_untracked(self):
         untracked = self.scm.untracked()
         for f in untracked:
-            if re.match(r'(.+)\.(lib|bld)$', f) and os.path.isfile(f):
+            if re.match(r'(.+)\.(lib|bld)$', f) and os.path.isfile(os.path.join(getcwd(), f)):
                 action("Remove untracked library reference \"%s\"" % f)
-                os.remove(f)
+                os.remove(os.path.join(getcwd(), f))
 
     def url2cachedir(self, url):
         up = urlparse(formaturl(url, 'https'))
@@ -1387,20 +2158,90 @@ class Repo(object):
         if cpath and os.path.isdir(os.path.join(cpath, '.'+scm)):
             return cpath
 
+    # Updates the cache mirror of url with the new revisions of the repository (the cache is
+    # never copied over, and objects that clones might borrow are never removed)
     def set_cache(self, url):
         cpath = self.url2cachedir(url)
-        if cpath and os.path.isdir(self.path):
+        if cpath and os.path.isdir(self.path) and hasattr(self.scm, 'cache_init'):
+            if self.isshallow():
+                # e.g. a pinned revision fetched without branches, which would leave the mirror empty
+                info("Not caching shallow clone \"%s\"" % self.path)
+                return False
+            if self.ispartial():
+                # The clone lacks the file contents, and fetching them for the mirror defeats the sparse checkout
+                info("Not caching partial clone \"%s\"" % self.path)
+                return False
             try:
-                if not os.path.isdir(cpath):
-                    os.makedirs(cpath)
-                scm_dir = '.'+self.scm.name
-                if os.path.isdir(os.path.join(cpath, scm_dir)):
-                    rmtree_readonly(os.path.join(cpath, scm_dir))
-                shutil.copytree(os.path.join(self.path, scm_dir), os.path.join(cpath, scm_dir))
+                # Also converts a cache left by older versions (a full copy) to a mirror in place
+                self.publish_cache(url, self.scm, self.scm.cache_init, self.path, url)
             except Exception:
                 warning("Unable to cache \"%s\" to \"%s\"" % (self.path, cpath))
         return False
 
+    # Runs func, which fetches revisions into the cache mirror in the current directory, in the
+    # mirror of url. New mirrors are created aside and published by renaming them, while
+    # updates of existing ones are published by the scm itself (git and hg write new objects
+    # before moving refs/heads). The caller holds the update lock of the cache.
+    def publish_cache(self, url, scm, func, *args):
+        cpath = self.url2cachedir(url)
+        if not os.path.isdir(cpath):
+            os.makedirs(cpath)
+        scm_dir = '.'+scm.name
+        if os.path.isdir(os.path.join(cpath, scm_dir)):
+            with cd(cpath):
+                func(*args)
+        else:
+            tmp = tempfile.mkdtemp(prefix='.new-', dir=cpath)
+            try:
+                with cd(tmp):
+                    func(*args)
+                os.rename(os.path.join(tmp, scm_dir), os.path.join(cpath, scm_dir))
+            finally:
+                rmtree_readonly(tmp)
+        CacheIndex(self.cache).fetched(cpath, url, scm.name)
+
+    # Fetches the repository from its remote into the cache mirror without a working copy (see
+    # "mbed cache warm"), and returns its library references at its revision
+    def warm_cache(self, fetch=True):
+        cpath = self.url2cachedir(self.url)
+        if not cpath or self.is_local or self.is_build:
+            return []
+
+        known = (self.scmhints(self.url) or [None])[0]
+        for scm in self.scmorder(self.url):
+            if not fetch:
+                # Already fetched, e.g. for another revision
+                if self.get_cache(self.url, scm.name):
+                    self.scm = scm
+                    break
+                continue
+            if not hasattr(scm, 'cache_fetch'):
+                continue
+            try:
+                with self.cache_update_held(self.url):
+                    # Only the likely SCM of the repository is retried (see clone())
+                    if scm.name == known:
+                        self.publish_cache(self.url, scm, transfers.run, self.url, scm.cache_fetch, self.url)
+                    else:
+                        with transfers.slot(self.url):
+                            self.publish_cache(self.url, scm, scm.cache_fetch, self.url)
+            except ProcessException:
+                continue
+            scm_memo.set(self.url, scm.name)
+            self.scm = scm
+            break
+        else:
+            warning(("Unable to cache repository \"%s\"" if fetch else "Repository \"%s\" is not cached") % self.url)
+            return []
+
+        with cd(cpath):
+            rev = self.rev if self.rev and self.rev not in ['latest', 'tip'] else self.scm.getbranch()
+        try:
+            return self.getrevlibs(rev, cpath)
+        except ProcessException:
+            warning("Revision \"%s\" of \"%s\" is not available in the cache" % (rev, self.url))
+            return []
+
     def cache_lock(self, url):
         cpath = self.url2cachedir(url)
         if not cpath:
@@ -1487,13 +2328,35 @@ class Repo(object):
             pass
         return True
 
+    # Readers of the cache take a shared lock, and removals an exclusive one
     @contextmanager
-    def cache_lock_held(self, url):
-        self.cache_lock(url)
-        try:
-            yield
-        finally:
-            self.cache_unlock(url)
+    def cache_lock_held(self, url, shared=False):
+        cpath = self.url2cachedir(url)
+        if cpath and fcntl:
+            if not os.path.isdir(cpath):
+                os.makedirs(cpath)
+            with filelock(os.path.join(cpath, '.cachelock'), shared):
+                yield
+            return
+
+        # Without file locks, the lock directory (pid based) is exclusive and only guards against other processes
+        with threadlock('cache', cpath):
+            self.cache_lock(url)
+            try:
+                yield
+            finally:
+                self.cache_unlock(url)
+
+    # Updates are published atomically, so they exclude each other and removals, but not readers
+    @contextmanager
+    def cache_update_held(self, url):
+        cpath = self.url2cachedir(url)
+        with self.cache_lock_held(url, shared=True):
+            if cpath and fcntl:
+                with filelock(os.path.join(cpath, '.updatelock')):
+                    yield
+            else:
+                yield
 
     def pid_exists(self, pid):
         try:
@@ -1508,6 +2371,17 @@ class Repo(object):
         else:
             return True
 
+    # Checks without network access whether the repository is already checked out
+    # at the specified revision (short or full hash) and has no uncommitted changes
+    def isuptodate(self, rev):
+        if not self.scm or not rev or not re.match(r'^([a-fA-F0-9]{6,40})$', rev):
+            return False
+        try:
+            cur = self.getrev()
+            return bool(cur) and (cur.startswith(rev) or rev.startswith(cur)) and not self.dirty()
+        except ProcessException:
+            return False
+
     def can_update(self, clean, clean_deps):
         err = None
         if (self.is_local or self.url is None) and not clean_deps:
@@ -1548,6 +2422,243 @@ class Repo(object):
         return True
 
 
+# Dependency graph of all library references (.lib/.bld) in the program. Nodes are
+# keyed by the canonical (https) URL, so a library referenced from multiple places
+# is fetched only once and its local copy is reused for all other references.
+class DepGraph(object):
+    def __init__(self):
+        self.nodes = {}
+        self.walked = set()
+        self.reported = set()
+        self.lock = threading.RLock()
+
+    @classmethod
+    def key(cls, url):
+        return formaturl(url, 'https').rstrip('/')
+
+    def node(self, url):
+        key = self.key(url)
+        with self.lock:
+            if key not in self.nodes:
+                self.nodes[key] = {'url': url, 'refs': {}, 'sources': {}}
+            return self.nodes[key]
+
+    # Registers a library reference
+    def add(self, lib):
+        if lib.is_local or not lib.url:
+            return
+        with self.lock:
+            self.node(lib.url)['refs'][lib.path] = lib.rev
+
+    # Registers all library references in the existing tree under repo (no SCM calls)
+    def walk(self, repo):
+        with self.lock:
+            if repo.path in self.walked:
+                return
+            self.walked.add(repo.path)
+        for lib in repo.getlibs():
+            self.add(lib)
+            if os.path.isdir(lib.path):
+                self.walk(lib)
+
+    # Records that path contains an up-to-date local copy of url
+    def mark(self, url, path, scm):
+        with self.lock:
+            self.node(url)['sources'][scm] = path
+
+    # Returns a local copy of url (other than path) to fetch objects from
+    def source(self, url, scm, path=None):
+        with self.lock:
+            src = self.node(url)['sources'].get(scm)
+        if src and src != path and os.path.isdir(os.path.join(src, '.'+scm)):
+            return src
+
+    def conflicts(self):
+        result = []
+        with self.lock:
+            for key, node in sorted(self.nodes.items()):
+                revs = []
+                for rev in node['refs'].values():
+                    if rev and not [r for r in revs if r.startswith(rev) or rev.startswith(r)]:
+                        revs.append(rev)
+                if len(revs) > 1:
+                    result.append((key, sorted(node['refs'].items())))
+        return result
+
+    # Warns about libraries referenced with different revisions (once per library)
+    def report(self):
+        for key, refs in self.conflicts():
+            if key in self.reported:
+                continue
+            self.reported.add(key)
+            warning(
+                "Library \"%s\" is referenced with conflicting revisions:\n" % key +
+                "\n".join("%s at %s" % (relpath(cwd_root, path) or path, ('#' + rev) if rev else 'latest') for path, rev in refs))
+
+dep_graph = DepGraph()
+
+
+# Remembers the SCM of cloned repositories per URL and per host in the mbed user
+# directory, so that clones try the right SCM first instead of guessing by trial
+class ScmMemo(object):
+    file = "scms.json"
+
+    def __init__(self):
+        self.data = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.data is None:
+            try:
+                with open(os.path.join(Global().path, self.file)) as f:
+                    self.data = json.load(f)
+            except (IOError, OSError, ValueError):
+                self.data = {}
+            self.data.setdefault('urls', {})
+            self.data.setdefault('hosts', {})
+        return self.data
+
+    # Returns the SCM remembered for url and for its host
+    def get(self, url):
+        with self.lock:
+            data = self.load()
+            return data['urls'].get(DepGraph.key(url)), data['hosts'].get(Transfers.host(url) or '')
+
+    def set(self, url, scm):
+        key, host = DepGraph.key(url), Transfers.host(url)
+        if not host: # local repositories are recognized without cloning
+            return
+        with self.lock:
+            data = self.load()
+            if data['urls'].get(key) == scm and data['hosts'].get(host) == scm:
+                return
+            data['urls'][key] = scm
+            data['hosts'][host] = scm
+            try:
+                with open(os.path.join(Global().path, self.file), 'w') as f:
+                    json.dump(data, f, indent=4, sort_keys=True)
+            except (IOError, OSError):
+                pass
+
+scm_memo = ScmMemo()
+
+
+# Journal of the clone and checkout steps of import, deploy and update, kept in the program
+# root while the command runs. Steps are appended as "<step> <rev> <path>" lines, and the
+# journal is removed when the command completes. A journal left behind means the command
+# was interrupted, so running it again skips the libraries that were checked out, and
+# verifies the libraries whose clone was started but not completed.
+class Journal(object):
+    file = ".mbed_journal"
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.steps = {}
+        self.lock = threading.Lock()
+        try:
+            with open(os.path.join(self.path, self.file)) as f:
+                lines = f.read().split('\n')[:-1] # the last line is incomplete if writing it was interrupted
+        except (IOError, OSError):
+            lines = []
+
+        for line in lines:
+            m = re.match(r'^(start|clone|checkout) (\w+|-) (.+)$', line)
+            if m:
+                self.steps[m.group(3)] = (m.group(1), None if m.group(2) == '-' else m.group(2))
+
+    def key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.path).replace('\\', '/')
+
+    # Whether the journal contains steps of an interrupted command
+    def interrupted(self):
+        return bool(self.steps)
+
+    # Returns the last step recorded for path and its revision
+    def state(self, path):
+        with self.lock:
+            return self.steps.get(self.key(path), (None, None))
+
+    # Whether path was checked out at rev
+    def done(self, path, rev):
+        step, cur = self.state(path)
+        return step == 'checkout' and bool(rev and cur) and (cur.startswith(rev) or rev.startswith(cur))
+
+    # Records a step ("start" of a clone, completed "clone" or "checkout") durably
+    def record(self, step, path, rev=None):
+        key = self.key(path)
+        fl = os.path.join(self.path, self.file)
+        with self.lock:
+            self.steps[key] = (step, rev)
+            try:
+                with open(fl, 'a') as f:
+                    f.write("%s %s %s\n" % (step, rev or '-', key))
+                    f.flush()
+                    os.fsync(f.fileno())
+            except (IOError, OSError):
+                warning("Unable to write journal file %s" % fl)
+
+    def close(self):
+        fl = os.path.join(self.path, self.file)
+        if os.path.isfile(fl):
+            os.remove(fl)
+
+journal = None
+
+# Prepares a library whose clone was interrupted (journaled as started but not completed)
+# to be deployed. The repository is verified and its working copy restored, or it's removed
+# to be cloned again if it isn't usable.
+def resume_lib(path):
+    if not journal or journal.state(path)[0] != 'start' or not os.path.isdir(path):
+        return
+    try:
+        if not Repo.isrepo(path):
+            raise ProcessException(1, "Not a repository")
+        lib = Repo.fromrepo(path)
+        if not hasattr(lib.scm, 'verify'):
+            raise ProcessException(1, "Unable to verify repository")
+        lib.verify()
+        rev = lib.getrev()
+        if not rev:
+            raise ProcessException(1, "No revision checked out")
+        lib.checkout(rev, True, detach=True)
+        info("Resuming interrupted clone of \"%s\"" % relpath(cwd_root, path))
+        journal.record('clone', path, rev)
+    except ProcessException:
+        action("Removing partially cloned library \"%s\"" % relpath(cwd_root, path))
+        rmtree_readonly(path)
+
+# Opens the journal of the program containing path for a top-level command
+def open_journal(path, command):
+    result = Journal(Program(path).path)
+    if result.interrupted():
+        action("Resuming interrupted %s in \"%s\"" % (command, result.path))
+    return result
+
+
+# Sparse checkout patterns for mbed OS, which exclude the directories of all targets
+# (targets/**/TARGET_*) except the ones labelled by target and its parents in targets.json
+def sparse_patterns(targets, target):
+    if target not in targets:
+        return None
+    labels = set()
+    names = [target]
+    while names:
+        name = names.pop()
+        if name not in targets:
+            continue
+        labels.add(name)
+        labels.update(targets[name].get('extra_labels', []) + targets[name].get('extra_labels_add', []))
+        names.extend(targets[name].get('inherits', []))
+    return ['/*', '!/targets/**/TARGET_*/'] + ['/targets/**/TARGET_%s/' % label for label in sorted(labels)]
+
+# Returns the target for sparse checkout if path is mbed OS being cloned into a program
+def sparse_target(path):
+    path = os.path.join(getcwd(), path)
+    if os.path.basename(path) != 'mbed-os':
+        return None
+    return Program(os.path.dirname(path)).get_sparse_target()
+
+
 # Program class, acts code base root
 class Program(object):
     path = None
@@ -1610,6 +2721,22 @@ class Program(object):
         else:
             return None
 
+    # Gets the target for sparse checkout of mbed OS, if enabled
+    def get_sparse_target(self):
+        if self.get_cfg('SPARSE') != 'enabled':
+            return None
+        target = self.get_cfg('TARGET')
+        return target if target and target.lower() not in ['detect', 'auto'] else None
+
+    # Updates the sparse checkout of mbed OS for the current target (or disables it)
+    def refresh_sparse(self):
+        os_dir = self.get_os_dir()
+        if not os_dir or not os.path.isdir(os.path.join(os_dir, '.'+Git.name)):
+            return False
+        with cd(os_dir):
+            Git.sparse(self.get_sparse_target())
+        return True
+
     def get_mbedlib_dir(self):
         if os.path.isdir(os.path.join(self.path, 'mbed')):
             return os.path.join(self.path, 'mbed')
@@ -1836,6 +2963,49 @@ class Program(object):
             except IOError:
                 error("Unable to write build ignore file in \"%s\"" % os.path.join(build_path, '.mbedignore'), 1)
 
+    # Records the resolved URL, revision and SCM of every library in the lock file
+    def write_lock(self):
+        libs = []
+
+        def add_libs(repo):
+            for lib in sorted(repo.libs, key=lambda l: l.path):
+                if not os.path.isdir(lib.path) or not Repo.isrepo(lib.path):
+                    warning("Library \"%s\" is missing and won't be added to the lock file." % relpath(self.path, lib.path))
+                    continue
+                lib_repo = Repo.fromrepo(lib.path)
+                if lib_repo.is_local or not lib_repo.rev:
+                    warning("Library \"%s\" is not published to a remote repository and won't be added to the lock file." % relpath(self.path, lib.path))
+                    continue
+                libs.append({
+                    'path': relpath(self.path, lib_repo.path).replace('\\', '/'),
+                    'url': lib_repo.refurl(),
+                    'rev': lib_repo.rev,
+                    'scm': lib_repo.scm.name})
+                add_libs(lib_repo)
+
+        add_libs(Repo.fromrepo(self.path))
+
+        fl = os.path.join(self.path, lock_file_name)
+        try:
+            with open(fl, 'w') as f:
+                json.dump({'libraries': libs}, f, indent=4, sort_keys=True)
+                f.write('\n')
+        except IOError:
+            error("Unable to write lock file \"%s\"" % fl, 1)
+        action("Locked %d libraries in \"%s\"" % (len(libs), lock_file_name))
+
+    def read_lock(self):
+        fl = os.path.join(self.path, lock_file_name)
+        if not os.path.isfile(fl):
+            error(
+                "Could not find lock file \"%s\" in program \"%s\".\n"
+                "You can create it with \"mbed update --write-lock\"." % (lock_file_name, self.path), 1)
+        try:
+            with open(fl) as f:
+                return json.load(f)['libraries']
+        except (IOError, ValueError, KeyError):
+            error("Unable to read lock file \"%s\"" % fl, 1)
+
     def detect_single_target(self, info=None):
         targets = self.get_detected_targets()
         if targets == False:
@@ -1971,7 +3141,33 @@ class Cfg(object):
         cache_dir_cfg = self.get('CACHE_DIR', None)
         loc = cache_dir_cfg if cache_dir_cfg != 'default' else (cache_cfg if (cache_cfg and cache_cfg != 'on' and cache_cfg != 'off' and cache_cfg != 'none' and cache_cfg != 'enabled' and cache_cfg != 'disabled') else None)
         cache_base = loc or Global().path
-        return {'cache': cache_val, 'cache_base': cache_base, 'cache_dir': os.path.join(cache_base, 'mbed-cache')}
+        cache_mode = self.get('CACHE_MODE', 'copy')
+        return {'cache': cache_val, 'cache_base': cache_base, 'cache_dir': os.path.join(cache_base, 'mbed-cache'),
+                'mode': cache_mode if cache_mode in cache_modes else 'copy',
+                'limit': parse_size(self.get('CACHE_LIMIT', None) or 0) or 0}
+
+
+def getjobs(jobs=None, default=default_jobs):
+    try:
+        return max(int(jobs or Program().get_cfg('JOBS') or default), 1)
+    except ValueError:
+        error("Invalid number of parallel jobs \"%s\"" % (jobs or Program().get_cfg('JOBS')), 1)
+
+# Number of retries of failed network operations
+def getretries():
+    retries = Program().get_cfg('RETRIES')
+    try:
+        return max(int(retries), 0) if retries else default_retries
+    except ValueError:
+        error("Invalid number of retries \"%s\"" % retries, 1)
+
+# Seconds after which a task of a parallel operation (e.g. cloning a library) is cancelled
+def gettimeout():
+    timeout = Program().get_cfg('TIMEOUT')
+    try:
+        return float(timeout) if timeout else None
+    except ValueError:
+        error("Invalid timeout \"%s\"" % timeout, 1)
 
 
 def formaturl(url, format="default"):
@@ -2177,6 +3373,7 @@ def new(name, scm='git', program=False, library=False, mbedlib=False, create_onl
     dict(name='--protocol', nargs='?', help='Transport protocol for the source control management. Supported: https, http, ssh, git. Default: inferred from URL.'),
     dict(name='--insecure', action='store_true', help='Allow insecure repository URLs. By default mbed CLI imports only "safe" URLs, e.g. based on standard ports - 80, 443 and 22. This option enables the use of arbitrary URLs/ports.'),
     dict(name='--offline', action='store_true', help='Offline mode will force the use of locally cached repositories and prevent requests to remote repositories.'),
+    dict(name=['-j', '--jobs'], type=int, help='Number of libraries to clone in parallel. Default: 1 (or the "jobs" config value).'),
     dict(name='--no-requirements', action='store_true', help='Disables checking for and installing any requirements.'),
     hidden_aliases=['im', 'imp'],
     help='Import program from URL',
@@ -2184,8 +3381,8 @@ def new(name, scm='git', program=False, library=False, mbedlib=False, create_onl
         "Imports mbed program and its dependencies from a source control based URL\n"
         "(GitHub, Bitbucket, mbed.org) into the current directory or specified\npath.\n"
         "Use \"mbed add <URL>\" to add a library into an existing program."))
-def import_(url, path=None, ignore=False, depth=None, protocol=None, insecure=False, offline=False, no_requirements=False, top=True):
-    global cwd_root
+def import_(url, path=None, ignore=False, depth=None, protocol=None, insecure=False, offline=False, jobs=None, no_requirements=False, top=True):
+    global cwd_root, journal
     offline_warning(offline, top)
 
     # translate 'mbed-os' to https://github.com/ARMmbed/mbed-os
@@ -2194,7 +3391,12 @@ def import_(url, path=None, ignore=False, depth=None, protocol=None, insecure=Fa
         url = mbed_base_url+'/'+url
 
     repo = Repo.fromurl(url, path)
-    if top:
+    # The program is cloned before its journal is started, so a journal means that only libraries are missing
+    resume = top and os.path.isdir(repo.path) and Journal(repo.path).interrupted()
+    if resume:
+        # A journal is also left behind by failures, so only the same program is resumed
+        resume = Repo.isrepo(repo.path) and formaturl(Repo.fromrepo(repo.path).url, 'https') == formaturl(repo.url, 'https')
+    if top and not resume:
         p = Program(path)
         if p and not p.is_cwd:
             error("Cannot import program in the specified location \"%s\" because it's already part of a program \"%s\".\n"
@@ -2202,24 +3404,43 @@ def import_(url, path=None, ignore=False, depth=None, protocol=None, insecure=Fa
 
     protocol = protocol or Program().get_cfg('PROTOCOL')
     insecure = insecure or Program().get_cfg('INSECURE')
+    jobs = getjobs(jobs)
 
     if not insecure and Repo.isinsecure(url):
         error("Cannot import \"%s\" in \"%s\" due to arbitrary service schema/port in the repository URL.\nRepositories are usually hosted on service port 443 (https), 80 (http), or 22 (ssh).\nYou can use the \"--insecure\" switch to enable the use of arbitrary repository URLs." % (repo.url, repo.path), 255)
 
-    if os.path.isdir(repo.path) and len(os.listdir(repo.path)) > 1:
+    if os.path.isdir(repo.path) and len(os.listdir(repo.path)) > 1 and not resume:
         error("Directory \"%s\" is not empty. Please ensure that the destination folder is empty." % repo.path, 1)
 
     if not Repo.isurl(orig_url) and os.path.exists(orig_url):
         warning("Importing from a local folder \"%s\", not from a URL" % orig_url)
 
     text = "Importing program" if top else "Adding library"
-    action("%s \"%s\" from \"%s\"%s" % (text, relpath(cwd_root, repo.path), formaturl(repo.url, protocol), ' at '+(repo.revtype(repo.rev))))
-    if repo.clone(repo.url, repo.path, rev=repo.rev, depth=depth, protocol=protocol, offline=offline):
+    if resume:
+        action("Resuming interrupted import of program \"%s\" from \"%s\"" % (repo.name, formaturl(repo.url, protocol)))
+        journal = Journal(repo.path)
+        repo.scm = repo.getscm()
+    else:
+        action("%s \"%s\" from \"%s\"%s" % (text, relpath(cwd_root, repo.path), formaturl(repo.url, protocol), ' at '+(repo.revtype(repo.rev))))
+    if not os.path.isdir(repo.path):
+        # Don't leave a partially deployed library behind if a parallel deploy fails
+        WorkQueue.cleanup(rmtree_readonly, repo.path)
+        if journal:
+            journal.record('start', repo.path)
+    if resume or repo.clone(repo.url, repo.path, rev=repo.rev, depth=depth, protocol=protocol, offline=offline):
         with cd(repo.path):
             Program(repo.path).set_root()
+            if top and not resume:
+                journal = Journal(repo.path)
+            rev = repo.getrev()
+            if journal and not resume:
+                journal.record('clone', repo.path, rev)
             try:
-                if repo.rev and repo.getrev() != repo.rev:
+                if repo.rev and rev != repo.rev:
                     repo.checkout(repo.rev, True)
+                    rev = repo.getrev()
+                if journal:
+                    journal.record('checkout', repo.path, rev)
             except ProcessException as e:
                 err = "Unable to update \"%s\" to %s" % (repo.name, repo.revtype(repo.rev))
                 if depth:
@@ -2241,9 +3462,11 @@ def import_(url, path=None, ignore=False, depth=None, protocol=None, insecure=Fa
         cwd_root = repo.path
 
     with cd(repo.path):
-        deploy(ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, top=False)
+        deploy(ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, jobs=jobs, top=False)
 
     if top:
+        journal.close()
+        journal = None
         Program(repo.path).post_action(not no_requirements)
 
 
@@ -2306,27 +3529,67 @@ def remove(path):
     dict(name='--protocol', nargs='?', help='Transport protocol for the source control management. Supported: https, http, ssh, git. Default: inferred from URL.'),
     dict(name='--insecure', action='store_true', help='Allow insecure repository URLs. By default mbed CLI imports only "safe" URLs, e.g. based on standard ports - 80, 443 and 22. This option enables the use of arbitrary URLs/ports.'),
     dict(name='--offline', action='store_true', help='Offline mode will force the use of locally cached repositories and prevent requests to remote repositories.'),
+    dict(name=['-j', '--jobs'], type=int, help='Number of libraries to clone in parallel. Default: 1 (or the "jobs" config value).'),
+    dict(name='--locked', action='store_true', help='Deploy the exact library revisions recorded in the "%s" file (see "mbed update --write-lock").' % lock_file_name),
     dict(name='--no-requirements', action='store_true', help='Disables checking for and installing any requirements.'),
     help='Find and add missing libraries',
     description=(
         "Import missing dependencies in an existing program or library.\n"
         "Hint: Use \"mbed import <URL>\" and \"mbed add <URL>\" instead of cloning\n"
         "manually and then running \"mbed deploy\""))
-def deploy(ignore=False, depth=None, protocol=None, insecure=False, offline=False, no_requirements=False, top=True):
+def deploy(ignore=False, depth=None, protocol=None, insecure=False, offline=False, jobs=None, locked=False, no_requirements=False, top=True):
+    global journal
     offline_warning(offline, top)
 
     repo = Repo.fromrepo()
     repo.ignores()
-    for lib in repo.libs:
+    jobs = getjobs(jobs)
+
+    if top:
+        journal = open_journal(repo.path, "deploy")
+
+    if locked:
+        deploy_locked(Program(repo.path), ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, jobs=jobs)
+        if top:
+            journal.close()
+            journal = None
+            Program(repo.path).post_action(not no_requirements)
+        return
+
+    dep_graph.walk(repo)
+    dep_graph.report()
+
+    def deploy_lib(lib):
+        resume_lib(lib.path)
         if os.path.isdir(lib.path):
             if lib.check_repo():
+                lib.scm = lib.getscm()
                 with cd(lib.path):
-                    update(lib.rev, ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, top=False)
+                    if (journal and journal.done(lib.path, lib.rev)) or lib.isuptodate(lib.rev):
+                        # Nothing to fetch or check out, but the library dependencies might be missing
+                        info("Library \"%s\" is already at rev #%s" % (relpath(cwd_root, lib.path), lib.rev[:12]))
+                        deploy(ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, jobs=jobs, top=False)
+                    else:
+                        update(lib.rev, ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, top=False)
         else:
-            import_(lib.fullurl, lib.path, ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, top=False)
-            repo.ignore(relpath(repo.path, lib.path))
+            import_(lib.fullurl, lib.path, ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, jobs=jobs, top=False)
+            with threadlock(repo.path):
+                repo.ignore(relpath(repo.path, lib.path))
+
+    # Libraries are queued to the active work queue (if called from a worker), so
+    # dependencies of freshly cloned libraries are picked up as soon as possible
+    work = WorkQueue.current() or (WorkQueue(jobs) if jobs > 1 else None)
+    for lib in repo.libs:
+        if work:
+            work.put(deploy_lib, lib)
+        else:
+            deploy_lib(lib)
+    if work and not isworker():
+        work.join()
 
     if top:
+        journal.close()
+        journal = None
         program = Program(repo.path)
         program.post_action(not no_requirements)
         if program.is_classic:
@@ -2336,6 +3599,7 @@ def deploy(ignore=False, depth=None, protocol=None, insecure=False, offline=Fals
 @subcommand('publish',
     dict(name=['-A', '--all'], dest='all_refs', action='store_true', help='Publish all branches, including new ones. Default: push only the current branch.'),
     dict(name=['-M', '--message'], dest='msg', type=str, nargs='?', help='Commit message. Default: prompts for commit message.'),
+    dict(name=['-j', '--jobs'], type=int, help='Number of repositories to push in parallel. Default: 1 (or the "jobs" config value).'),
     hidden_aliases=['pub'],
     help='Publish program or library',
     description=(
@@ -2344,46 +3608,74 @@ def deploy(ignore=False, depth=None, protocol=None, insecure=False, offline=Fals
         "and unpublished revisions and encourages to commit/push them.\n"
         "Online guide about collaboration is available at:\n"
         "www.mbed.com/collab_guide"))
-def publish(all_refs=None, msg=None, top=True):
-    if top:
-        action("Checking for local modifications...")
+def publish(all_refs=None, msg=None, jobs=None):
+    action("Checking for local modifications...")
+
+    # Commit local changes bottom-up first, so all commit prompts are done before pushing
+    repos = {}
+    parents = {}
+    children = {}
+    def commit(top=False):
+        repo = Repo.fromrepo()
+        if repo.is_local:
+            error(
+                "%s \"%s\" in \"%s\" is a local repository.\nPlease associate it with a remote repository URL before attempting to publish.\n"
+                "Read more about publishing local repositories here:\nhttps://github.com/ARMmbed/mbed-cli/#publishing-local-program-or-library" % ("Program" if top else "Library", repo.name, repo.path), 1)
 
-    repo = Repo.fromrepo()
-    if repo.is_local:
-        error(
-            "%s \"%s\" in \"%s\" is a local repository.\nPlease associate it with a remote repository URL before attempting to publish.\n"
-            "Read more about publishing local repositories here:\nhttps://github.com/ARMmbed/mbed-cli/#publishing-local-program-or-library" % ("Program" if top else "Library", repo.name, repo.path), 1)
+        repos[repo.path] = repo
+        children[repo.path] = 0
+        for lib in repo.libs:
+            if lib.check_repo():
+                with cd(lib.path):
+                    progress()
+                    parents[commit()] = repo.path
+                    children[repo.path] += 1
 
-    for lib in repo.libs:
-        if lib.check_repo():
-            with cd(lib.path):
-                progress()
-                publish(all_refs, msg=msg, top=False)
+        sync(recursive=False, jobs=jobs)
 
-    sync(recursive=False)
+        if repo.dirty():
+            action("Uncommitted changes in %s \"%s\" in \"%s\"" % (repo.pathtype(repo.path), repo.name, repo.path))
+            if msg:
+                repo.commit(msg)
+            else:
+                if sys.version_info[0] == 3:
+                    input('Press enter to commit and publish: ')
+                else:
+                    raw_input('Press enter to commit and publish: ')
+                repo.commit()
+        return repo.path
 
-    if repo.dirty():
-        action("Uncommitted changes in %s \"%s\" in \"%s\"" % (repo.pathtype(repo.path), repo.name, repo.path))
-        if msg:
-            repo.commit(msg)
-        else:
-            if sys.version_info[0] == 3:
-                input('Press enter to commit and publish: ')
+    top_path = commit(top=True)
+
+    # Push repositories concurrently, but libraries always before their parents,
+    # so the revisions referenced in the parent's .lib files are published first
+    lock = threading.Lock()
+    def push(repo):
+        try:
+            outgoing = repo.outgoing()
+            if outgoing > 0:
+                action("Pushing local repository \"%s\" to remote \"%s\"" % (repo.name, repo.url))
+                repo.publish(all_refs)
             else:
-                raw_input('Press enter to commit and publish: ')
-            repo.commit()
+                if repo.path == top_path:
+                    action("Nothing to publish to the remote repository (the source tree is unmodified)")
+        except ProcessException as e:
+            if e.args[0] != 1:
+                raise e
 
-    try:
-        outgoing = repo.outgoing()
-        if outgoing > 0:
-            action("Pushing local repository \"%s\" to remote \"%s\"" % (repo.name, repo.url))
-            repo.publish(all_refs)
-        else:
-            if top:
-                action("Nothing to publish to the remote repository (the source tree is unmodified)")
-    except ProcessException as e:
-        if e.args[0] != 1:
-            raise e
+        parent = parents.get(repo.path)
+        if parent:
+            with lock:
+                children[parent] -= 1
+                ready = children[parent] == 0
+            if ready:
+                q.put(push, repos[parent])
+
+    q = WorkQueue(getjobs(jobs))
+    for path, count in sorted(children.items()):
+        if count == 0:
+            q.put(push, repos[path])
+    q.join()
 
 
 # Update command
@@ -2398,6 +3690,9 @@ def publish(all_refs=None, msg=None, top=True):
     dict(name='--insecure', action='store_true', help='Allow insecure repository URLs. By default mbed CLI imports only "safe" URLs, e.g. based on standard ports - 80, 443 and 22. This option enables the use of arbitrary URLs/ports.'),
     dict(name='--offline', action='store_true', help='Offline mode will force the use of locally cached repositories and prevent requests to remote repositories.'),
     dict(name=['-l', '--latest-deps'], action='store_true', help='Update all dependencies to the latest revision of their current branch. WARNING: Ignores lib files'),
+    dict(name=['-j', '--jobs'], type=int, help='Number of libraries to fetch and clone in parallel. Default: 1 (or the "jobs" config value).'),
+    dict(name='--write-lock', action='store_true', help='Record the resolved URL and revision of every library in the "%s" file after updating.' % lock_file_name),
+    dict(name='--plan', action='store_true', help='Print the actions the update would perform (remove, clone, fetch, checkout) as JSON, using local data only, and exit without changing anything.'),
     dict(name='--no-requirements', action='store_true', help='Disables checking for and installing any requirements.'),
     hidden_aliases=['up'],
     help='Update to branch, tag, revision or latest',
@@ -2405,11 +3700,24 @@ def publish(all_refs=None, msg=None, top=True):
         "Updates the current program or library and its dependencies to specified\nbranch, tag or revision.\n"
         "Alternatively fetches from associated remote repository URL and updates to the\n"
         "latest revision in the current branch."))
-def update(rev=None, clean=False, clean_files=False, clean_deps=False, ignore=False, depth=None, protocol=None, insecure=False, offline=False, latest_deps=False, no_requirements=False, top=True):
+def update(rev=None, clean=False, clean_files=False, clean_deps=False, ignore=False, depth=None, protocol=None, insecure=False, offline=False, latest_deps=False, jobs=None, write_lock=False, plan=False, no_requirements=False, fetched=None, top=True):
+    global journal
+    if plan:
+        actions = plan_update(rev, latest_deps)
+        summary = {}
+        for entry in actions:
+            summary[entry['action']] = summary.get(entry['action'], 0) + 1
+        print(json.dumps({'actions': actions, 'summary': summary}, indent=4, sort_keys=True))
+        return
+
     offline_warning(offline, top)
 
     if top and clean:
-        sync()
+        sync(jobs=jobs)
+
+    jobs = getjobs(jobs)
+    if top and jobs > 1 and not offline:
+        fetched = fetch_tree(plan_update(rev, latest_deps), jobs)
 
     cwd_type = Repo.pathtype(cwd_root)
     cwd_dest = "program" if cwd_type == "directory" else "library"
@@ -2418,6 +3726,11 @@ def update(rev=None, clean=False, clean_files=False, clean_deps=False, ignore=Fa
     # A copy of repo containing the .lib layout before updating
     repo_orig = Repo.fromrepo()
 
+    if top:
+        journal = open_journal(repo.path, "update")
+        dep_graph.walk(repo)
+        dep_graph.report()
+
     if top and not rev and repo.isdetached():
         error(
             "This %s is in detached HEAD state, and you won't be able to receive updates from the remote repository until you either checkout a branch or create a new one.\n"
@@ -2432,6 +3745,8 @@ def update(rev=None, clean=False, clean_files=False, clean_deps=False, ignore=Fa
         action("Skipping unpublished empty %s \"%s\"" % (
             cwd_type if top else cwd_dest,
             os.path.basename(repo.path) if top else relpath(cwd_root, repo.path)))
+    elif not top and not clean_files and ((not clean and journal and journal.done(repo.path, rev)) or repo.isuptodate(rev)):
+        info("Library \"%s\" is already at rev #%s" % (relpath(cwd_root, repo.path), rev[:12]))
     else:
         # Fetch from remote repo
         action("Updating %s \"%s\" to %s" % (
@@ -2440,17 +3755,20 @@ def update(rev=None, clean=False, clean_files=False, clean_deps=False, ignore=Fa
             repo.revtype(rev)))
 
         try:
-            repo.update(rev, clean, clean_files, offline or repo.is_local)
+            repo.update(rev, clean, clean_files, offline or repo.is_local or repo.path in (fetched or []))
         except ProcessException as e:
             err = "Unable to update \"%s\" to %s" % (repo.name, repo.revtype(rev))
             if offline:
                 err = err + "\nThis might be caused by offline mode ('--offline' used). You should try without offline mode."
             elif depth:
-                err = err + ("\nThis might be caused by the '--depth' option, which prevents fetching the whole revision history." % (repo.revtype(repo.rev)))
+                err = err + "\nThis might be caused by the '--depth' option, which prevents fetching the whole revision history."
             if ignore:
                 warning(err)
             else:
                 error(err, e.args[0])
+        else:
+            if journal:
+                journal.record('checkout', repo.path, repo.getrev())
 
         repo.rm_untracked()
         if top and cwd_type == 'library':
@@ -2496,74 +3814,279 @@ def update(rev=None, clean=False, clean_files=False, clean_deps=False, ignore=Fa
 
     # Import missing repos and update to revs
     for lib in repo.libs:
+        resume_lib(lib.path)
         if not os.path.isdir(lib.path):
-            import_(lib.fullurl, lib.path, ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, top=False)
+            import_(lib.fullurl, lib.path, ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, jobs=jobs, top=False)
             repo.ignore(relpath(repo.path, lib.path))
         else:
             with cd(lib.path):
-                update(None if latest_deps else lib.rev, clean=clean, clean_files=clean_files, clean_deps=clean_deps, ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, latest_deps=latest_deps, top=False)
+                update(None if latest_deps else lib.rev, clean=clean, clean_files=clean_files, clean_deps=clean_deps, ignore=ignore, depth=depth, protocol=protocol, insecure=insecure, offline=offline, latest_deps=latest_deps, jobs=jobs, fetched=fetched, top=False)
 
     if top:
+        journal.close()
+        journal = None
         program = Program(repo.path)
         program.set_root()
+        if write_lock:
+            program.write_lock()
         program.post_action(not no_requirements)
         if program.is_classic:
             program.update_tools(os.path.join(getcwd(), '.temp'))
 
 
+# Plans the update of the repository in the current directory to rev and of its libraries
+# from local data only (library references, local revisions and cached repositories).
+# Returns the actions in update order, each with an estimated cost ("none", "local" or
+# "network"). Library references of repositories that need fetching are only known after
+# the fetch, so their libraries are planned from the references in the working copy.
+def plan_update(rev=None, latest_deps=False):
+    plan = []
+
+    def add(action, repo, rev, cost, **kwargs):
+        entry = {'action': action, 'path': relpath(cwd_root, repo.path) or '.', 'url': repo.url, 'rev': rev, 'cost': cost}
+        entry.update(kwargs)
+        plan.append(entry)
+
+    def plan_clone(lib):
+        cached = [scm for scm in scms if lib.get_cache(lib.url, scm)]
+        add('clone', lib, lib.rev, 'local' if cached else 'network')
+
+    def plan_repo(repo, rev, top=False):
+        libs = repo.libs
+        if repo.is_local and not repo.rev:
+            add('skip', repo, rev, 'none', reason='unpublished')
+        elif not top and repo.isuptodate(rev):
+            add('uptodate', repo, rev, 'none')
+        elif repo.is_local or repo.hasrev(rev):
+            add('checkout', repo, rev, 'local', current=repo.rev)
+            if rev:
+                libs = repo.getrevlibs(rev)
+        else:
+            add('fetch', repo, rev, 'network', current=repo.rev)
+
+        paths = set(lib.path for lib in libs)
+        for lib in repo.libs:
+            if lib.path not in paths and os.path.isdir(lib.path):
+                add('remove', lib, None, 'local', reason='obsolete')
+
+        for lib in libs:
+            if os.path.isdir(lib.path) and Repo.isrepo(lib.path):
+                lib_repo = Repo.fromrepo(lib.path)
+                if (not lib.is_local and not lib_repo.is_local and
+                    formaturl(lib.url, 'https') != formaturl(lib_repo.url, 'https')):
+                    add('remove', lib_repo, None, 'local', reason='changed URL')
+                    plan_clone(lib)
+                else:
+                    plan_repo(lib_repo, None if latest_deps else lib.rev)
+            elif not os.path.isdir(lib.path):
+                plan_clone(lib)
+
+    plan_repo(Repo.fromrepo(), rev, top=True)
+    return plan
+
+
+# Fetches the repositories that the update plan needs to fetch in parallel, so that
+# update only has to check out revisions (in dependency order) afterwards.
+# Returns the paths of the fetched repositories.
+def fetch_tree(plan, jobs):
+    fetched = set()
+    work = WorkQueue(jobs)
+
+    def fetch_repo(path):
+        repo = Repo.fromrepo(path)
+        if repo.scm and repo.scm.name != 'bld' and not repo.is_local:
+            try:
+                # Repositories referenced multiple times are fetched from the network once
+                with threadlock('fetch', DepGraph.key(repo.url)):
+                    with cd(repo.path):
+                        repo.scm.fetch(dep_graph.source(repo.url, repo.scm.name, repo.path))
+                    dep_graph.mark(repo.url, repo.path, repo.scm.name)
+                fetched.add(repo.path)
+            except ProcessException:
+                pass # update will fetch again and report the error
+
+    # The plan reads library references from the working copies, so libraries of fetched
+    # repositories might be pinned to new revisions by the update and are fetched as well
+    fetches = [entry['path'] for entry in plan if entry['action'] == 'fetch']
+    paths = [os.path.join(cwd_root, entry['path']) for entry in plan
+             if entry['action'] == 'fetch' or (entry['action'] in ['uptodate', 'checkout']
+                 and any(p == '.' or entry['path'].startswith(p + os.sep) for p in fetches))]
+    if paths:
+        action("Fetching revisions from remote repositories (%d parallel jobs)" % jobs)
+    for path in paths:
+        work.put(fetch_repo, os.path.normpath(path))
+    work.join()
+    return fetched
+
+
+# Deploys the libraries recorded in the program lock file. Revisions are already
+# resolved, so each library is checked out by exact revision without querying
+# the remote repositories, and libraries are queued as soon as their parent is done.
+def deploy_locked(program, ignore=False, depth=None, protocol=None, insecure=False, offline=False, jobs=1):
+    entries = sorted(program.read_lock(), key=lambda e: e['path'])
+    protocol = protocol or program.get_cfg('PROTOCOL')
+    insecure = insecure or program.get_cfg('INSECURE')
+    for entry in entries:
+        if not insecure and Repo.isinsecure(entry['url']):
+            error("Cannot deploy \"%s\" in \"%s\" due to arbitrary service schema/port in the repository URL.\nRepositories are usually hosted on service port 443 (https), 80 (http), or 22 (ssh).\nYou can use the \"--insecure\" switch to enable the use of arbitrary repository URLs." % (entry['url'], entry['path']), 255)
+    children = {}
+    for entry in entries:
+        parents = [p['path'] for p in entries if entry['path'].startswith(p['path'] + '/')]
+        children.setdefault(max(parents, key=len) if parents else '', []).append(entry)
+
+    def deploy_entry(entry):
+        path = os.path.join(program.path, *entry['path'].split('/'))
+        lib = Repo.fromurl(entry['url'].rstrip('/') + ('/' if entry['scm'] == 'bld' else '#') + entry['rev'], path)
+        try:
+            resume_lib(path)
+            if not os.path.isdir(path):
+                action("Adding library \"%s\" from \"%s\" at %s" % (entry['path'], formaturl(lib.url, protocol), lib.revtype(lib.rev)))
+                WorkQueue.cleanup(rmtree_readonly, path)
+                if journal:
+                    journal.record('start', path)
+                if not lib.clone(lib.url, path, rev=lib.rev, depth=depth, protocol=protocol, offline=offline):
+                    raise ProcessException(1, lib.url, "clone", program.path)
+                if journal:
+                    journal.record('clone', path, lib.getrev())
+            lib.scm = lib.getscm()
+            if (not journal or not journal.done(path, lib.rev)) and lib.getrev() != lib.rev:
+                # Uncommitted changes are kept, as in "mbed deploy" (only resume_lib() discards them)
+                ok, err = lib.can_update(False, True)
+                if not ok:
+                    if ignore:
+                        warning(err)
+                        return
+                    error(err, 1)
+                action("Updating library \"%s\" to %s" % (entry['path'], lib.revtype(lib.rev)))
+                try:
+                    lib.checkout(lib.rev, True, detach=True)
+                except ProcessException:
+                    if offline:
+                        raise
+                    with cd(lib.path):
+                        lib.scm.fetch()
+                    lib.checkout(lib.rev, True, detach=True)
+                if journal:
+                    journal.record('checkout', path, lib.rev)
+        except ProcessException as e:
+            err = "Unable to deploy \"%s\" at %s from the lock file" % (entry['path'], lib.revtype(lib.rev))
+            if ignore:
+                warning(err)
+                return
+            error(err, e.args[0])
+
+        parent = Repo()
+        parent.path = os.path.dirname(path)
+        while parent.path != program.path and not Repo.isrepo(parent.path):
+            parent.path = os.path.dirname(parent.path)
+        parent.scm = parent.getscm()
+        with threadlock(parent.path):
+            parent.ignore(relpath(parent.path, path))
+
+        for child in children.get(entry['path'], []):
+            if work:
+                work.put(deploy_entry, child)
+            else:
+                deploy_entry(child)
+
+    work = WorkQueue(jobs) if jobs > 1 else None
+    for entry in children.get('', []):
+        if work:
+            work.put(deploy_entry, entry)
+        else:
+            deploy_entry(entry)
+    if work:
+        work.join()
+
+
 # Synch command
 @subcommand('sync',
+    dict(name=['-j', '--jobs'], type=int, help='Number of libraries to synchronize in parallel. Default: 1 (or the "jobs" config value).'),
     help='Synchronize library references\n\n',
     description=(
         "Synchronizes all library and dependency references (.lib files) in the\n"
         "current program or library.\n"
         "Note that this will remove all invalid library references."))
-def sync(recursive=True, keep_refs=False, top=True):
+def sync(recursive=True, keep_refs=False, jobs=None, top=True):
     if top and recursive:
         action("Synchronizing dependency references...")
 
     repo = Repo.fromrepo()
     repo.ignores()
+    jobs = getjobs(jobs)
 
-    for lib in repo.libs:
+    # The .lib files, ignore file and index of a repository are updated by one thread at a time
+    def sync_lib(lib):
         if os.path.isdir(lib.path):
             lib.check_repo()
             lib.sync()
-            lib.write()
-            repo.ignore(relpath(repo.path, lib.path))
+            with threadlock(repo.path):
+                lib.write()
+                repo.ignore(relpath(repo.path, lib.path))
             progress()
         else:
             if not keep_refs:
-                action("Removing reference \"%s\" -> \"%s\"" % (lib.name, lib.fullurl))
-                repo.remove(lib.lib)
-                repo.unignore(relpath(repo.path, lib.path))
+                with threadlock(repo.path):
+                    action("Removing reference \"%s\" -> \"%s\"" % (lib.name, lib.fullurl))
+                    repo.remove(lib.lib)
+                    repo.unignore(relpath(repo.path, lib.path))
 
+    def add_lib(path):
+        lib = Repo.fromrepo(path)
+        if os.path.isfile(lib.lib):
+            return
+        with threadlock(repo.path):
+            lib.write()
+            repo.ignore(relpath(repo.path, lib.path))
+            repo.add(lib.lib)
+        progress()
+
+    tasks = [(sync_lib, lib) for lib in repo.libs]
+    lib_paths = set(lib.path for lib in repo.libs)
     for root, dirs, files in os.walk(repo.path):
         dirs[:] = [d for d in dirs  if not d.startswith('.')]
         files[:] = [f for f in files if not f.startswith('.')]
 
         for d in list(dirs):
-            if not Repo.isrepo(os.path.join(root, d)):
-                continue
-
-            lib = Repo.fromrepo(os.path.join(root, d))
-            if os.path.isfile(lib.lib):
+            if Repo.isrepo(os.path.join(root, d)):
                 dirs.remove(d)
-                continue
-
-            dirs.remove(d)
-            lib.write()
-            repo.ignore(relpath(repo.path, lib.path))
-            repo.add(lib.lib)
-            progress()
-
-    repo.sync()
+                if os.path.join(root, d) not in lib_paths:
+                    tasks.append((add_lib, os.path.join(root, d)))
+
+    # Libraries are synchronized concurrently. The last finished library resumes with
+    # the repository itself and queues the library subtrees (if recursive).
+    work = WorkQueue.current() or (WorkQueue(jobs) if jobs > 1 else None)
+    lock = threading.Lock()
+    pending = [len(tasks)]
+    def finish():
+        repo.sync()
 
-    if recursive:
-        for lib in repo.libs:
-            if lib.check_repo():
-                with cd(lib.path):
-                    sync(keep_refs=keep_refs, top=False)
+        if recursive:
+            for lib in repo.libs:
+                if lib.check_repo():
+                    with cd(lib.path):
+                        if work:
+                            work.put(sync, keep_refs=keep_refs, jobs=jobs, top=False)
+                        else:
+                            sync(keep_refs=keep_refs, jobs=jobs, top=False)
+
+    def run(func, arg):
+        func(arg)
+        with lock:
+            pending[0] -= 1
+            done = pending[0] == 0
+        if done:
+            finish()
+
+    for task in tasks:
+        if work:
+            work.put(run, *task)
+        else:
+            run(*task)
+    if not tasks:
+        finish()
+    if work and not isworker():
+        work.join()
 
     # Update the .lib reference in the parent repository
     cwd_type = Repo.pathtype(cwd_root)
@@ -2572,25 +4095,51 @@ def sync(recursive=True, keep_refs=False, top=True):
         repo.write()
 
 
+# Queries repo and all libraries in the tree concurrently. Returns the repositories and
+# query results keyed by path, so the tree can be printed in a deterministic order.
+# Missing libraries are skipped here and reported with check_repo() while printing.
+def query_tree(repo, query, recursive=True, jobs=None):
+    results = {}
+    def query_repo(repo):
+        if repo is None:
+            repo = Repo.fromrepo(getcwd())
+        results[repo.path] = (repo, query(repo))
+        if recursive:
+            for lib in repo.libs:
+                if os.path.isdir(lib.path) and Repo.isrepo(lib.path):
+                    with cd(lib.path):
+                        q.put(query_repo, None)
+
+    q = WorkQueue(getjobs(jobs, default_query_jobs))
+    q.put(query_repo, repo)
+    q.join()
+    return results
+
+
 # List command
 @subcommand('ls',
     dict(name=['-a', '--all'], dest='detailed', action='store_true', help='List repository URL and revision pairs'),
     dict(name=['-I', '--ignore'], action='store_true', help='Ignore errors related to missing libraries.'),
+    dict(name=['-j', '--jobs'], type=int, help='Number of repositories to query in parallel. Default: %d (or the "jobs" config value).' % default_query_jobs),
     help='View dependency tree',
     description=(
         "View the dependency tree of the current program or library."))
-def list_(detailed=False, prefix='', p_path=None, ignore=False):
+def list_(detailed=False, ignore=False, jobs=None):
     repo = Repo.fromrepo()
+    tree = query_tree(repo, lambda repo: (repo.url + ('#' + str(repo.rev)[:12] if repo.rev else '') if detailed else repo.revtype(repo.rev, fmt=6)) or 'no revision', jobs=jobs)
+
+    def show(path, prefix='', p_path=None):
+        repo, desc = tree[path]
+        print("%s (%s)" % (prefix + (relpath(p_path, repo.path) if p_path else repo.name), desc))
 
-    print("%s (%s)" % (prefix + (relpath(p_path, repo.path) if p_path else repo.name), ((repo.url + ('#' + str(repo.rev)[:12] if repo.rev else '') if detailed else repo.revtype(repo.rev, fmt=6)) or 'no revision')))
+        for i, lib in enumerate(sorted(repo.libs, key=lambda l: l.path)):
+            nprefix = (prefix[:-3] + ('|  ' if prefix[-3] == '|' else '   ')) if prefix else ''
+            nprefix += '|- ' if i < len(repo.libs)-1 else '`- '
 
-    for i, lib in enumerate(sorted(repo.libs, key=lambda l: l.path)):
-        nprefix = (prefix[:-3] + ('|  ' if prefix[-3] == '|' else '   ')) if prefix else ''
-        nprefix += '|- ' if i < len(repo.libs)-1 else '`- '
+            if lib.check_repo(ignore):
+                show(lib.path, nprefix, repo.path)
 
-        if lib.check_repo(ignore):
-            with cd(lib.path):
-                list_(detailed, nprefix, repo.path, ignore=ignore)
+    show(repo.path)
 
 
 # Command release for cross-SCM release tags of repositories
@@ -2598,61 +4147,78 @@ def list_(detailed=False, prefix='', p_path=None, ignore=False):
     dict(name=['-a', '--all'], dest='detailed', action='store_true', help='Show revision hashes'),
     dict(name=['-u', '--unstable'], dest='unstable', action='store_true', help='Show unstable releases well, e.g. release candidates, alphas, betas, etc'),
     dict(name=['-r', '--recursive'], action='store_true', help='Show release tags for all libraries and sub-libraries as well'),
+    dict(name=['-j', '--jobs'], type=int, help='Number of repositories to query in parallel. Default: %d (or the "jobs" config value).' % default_query_jobs),
     hidden_aliases=['rel', 'rels'],
     help='Show release tags',
     description=(
         "Show release tags for the current program or library."))
-def releases_(detailed=False, unstable=False, recursive=False, prefix='', p_path=None):
-    repo = Repo.fromrepo()
-    tags = repo.gettags()
-    revtags = repo.gettags(repo.rev) if repo.rev and len(tags) else [] # associated tags with current commit
+def releases_(detailed=False, unstable=False, recursive=False, jobs=None):
     regex_rels = regex_rels_all if unstable else regex_rels_official
 
-    # Generate list of tags
-    rels = []
-    for tag in tags:
-        if re.match(regex_rels, tag[1]):
-            rels.append(tag[1] + " %s%s" % ('#' + tag[0] if detailed else "", " <- current" if tag[1] in revtags else ""))
-
-    # Print header
-    print("%s (%s)" % (prefix + (relpath(p_path, repo.path) if p_path else repo.name), ((repo.url + ('#' + str(repo.rev)[:12] if repo.rev else '') if detailed else repo.revtype(repo.rev, fmt=6)) or 'no revision')))
-
-    # Print list of tags
-    rprefix = (prefix[:-3] + ('|  ' if prefix[-3] == '|' else '   ')) if recursive and prefix else ''
-    rprefix += '| ' if recursive and len(repo.libs) > 1 else '  '
-    if len(rels):
-        for rel in rels:
-            print(rprefix + '* ' + rel)
-    else:
-        print(rprefix + 'No release tags detected')
+    def query(repo):
+        repo.unshallow() # tags aren't fetched with shallow clones
+        tags = repo.gettags()
+        revtags = repo.gettags(repo.rev) if repo.rev and len(tags) else [] # associated tags with current commit
 
-    if recursive:
-        for i, lib in enumerate(sorted(repo.libs, key=lambda l: l.path)):
-            nprefix = (prefix[:-3] + ('|  ' if prefix[-3] == '|' else '   ')) if prefix else ''
-            nprefix += '|- ' if i < len(repo.libs)-1 else '`- '
+        # Generate list of tags
+        rels = []
+        for tag in tags:
+            if re.match(regex_rels, tag[1]):
+                rels.append(tag[1] + " %s%s" % ('#' + tag[0] if detailed else "", " <- current" if tag[1] in revtags else ""))
+        return rels, ((repo.url + ('#' + str(repo.rev)[:12] if repo.rev else '') if detailed else repo.revtype(repo.rev, fmt=6)) or 'no revision')
 
-            if lib.check_repo():
-                with cd(lib.path):
-                    releases_(detailed, unstable, recursive, nprefix, repo.path)
+    repo = Repo.fromrepo()
+    tree = query_tree(repo, query, recursive, jobs=jobs)
+
+    def show(path, prefix='', p_path=None):
+        repo, (rels, desc) = tree[path]
+
+        # Print header
+        print("%s (%s)" % (prefix + (relpath(p_path, repo.path) if p_path else repo.name), desc))
+
+        # Print list of tags
+        rprefix = (prefix[:-3] + ('|  ' if prefix[-3] == '|' else '   ')) if recursive and prefix else ''
+        rprefix += '| ' if recursive and len(repo.libs) > 1 else '  '
+        if len(rels):
+            for rel in rels:
+                print(rprefix + '* ' + rel)
+        else:
+            print(rprefix + 'No release tags detected')
+
+        if recursive:
+            for i, lib in enumerate(sorted(repo.libs, key=lambda l: l.path)):
+                nprefix = (prefix[:-3] + ('|  ' if prefix[-3] == '|' else '   ')) if prefix else ''
+                nprefix += '|- ' if i < len(repo.libs)-1 else '`- '
+
+                if lib.check_repo():
+                    show(lib.path, nprefix, repo.path)
+
+    show(repo.path)
 
 
 # Command status for cross-SCM status of repositories
 @subcommand('status',
     dict(name=['-I', '--ignore'], action='store_true', help='Ignore errors related to missing libraries.'),
+    dict(name=['-j', '--jobs'], type=int, help='Number of repositories to query in parallel. Default: %d (or the "jobs" config value).' % default_query_jobs),
     hidden_aliases=['st', 'stat'],
     help='Show version control status\n\n',
     description=(
         "Show uncommitted changes a program or library and its dependencies."))
-def status_(ignore=False):
+def status_(ignore=False, jobs=None):
     repo = Repo.fromrepo()
-    if repo.dirty():
-        action("Status for \"%s\":" % repo.name)
-        log(repo.status()+"\n")
+    tree = query_tree(repo, lambda repo: repo.status() if repo.dirty() else None, jobs=jobs)
 
-    for lib in repo.libs:
-        if lib.check_repo(ignore):
-            with cd(lib.path):
-                status_(ignore)
+    def show(path):
+        repo, status = tree[path]
+        if status is not None:
+            action("Status for \"%s\":" % repo.name)
+            log(status+"\n")
+
+        for lib in repo.libs:
+            if lib.check_repo(ignore):
+                show(lib.path)
+
+    show(repo.path)
 
 
 # Helper function for compile and test subcommands
@@ -3245,7 +4811,7 @@ def sterm(target=None, port=None, baudrate=None, echo=None, reset=False, sterm=T
         "Gets, sets or unsets mbed tool configuration options.\n"
         "Options can be global (via the --global switch) or local (per program)\n"
         "Global options are always overridden by local/program options.\n"
-        "Currently supported options: target, toolchain, protocol, depth, cache, profile, color"))
+        "Currently supported options: target, toolchain, protocol, depth, jobs, timeout, retries, cache, sparse, profile, color"))
 def config_(var=None, value=None, global_cfg=False, unset=False, list_config=False):
     name = var
     var = str(var).upper()
@@ -3307,6 +4873,12 @@ def config_(var=None, value=None, global_cfg=False, unset=False, list_config=Fal
                     else:
                         action('No default %s set in program "%s"' % (name, program.name))
                         error("run with -h for detailed usage help")
+
+        # Changing the target widens/narrows the sparse checkout of mbed OS
+        if var in ['TARGET', 'SPARSE'] and (unset or value):
+            program = Program(getcwd())
+            if not program.is_cwd:
+                program.refresh_sparse()
     else:
         error("Too few arguments. Run with -h for detailed help")
 
@@ -3340,20 +4912,297 @@ def toolchain_(name=None, global_cfg=False, supported=False):
     return config_('toolchain', name, global_cfg=global_cfg)
 
 
+# Index of the mirrors in the repository cache (index.json in the cache directory) with their
+# url, scm, size and the times they were last fetched and used, so listing and evicting them
+# neither walks the cache nor runs the scm. Updates read and write the index under a file
+# lock and replace it by renaming. A cache without index (older versions) is scanned once.
+class CacheIndex(object):
+    file = "index.json"
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.cache_dir)).replace(os.sep, '/')
+
+    def load(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.file)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def scan(self):
+        data = {}
+        for dirpath, dirs, files in os.walk(self.cache_dir):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            if Repo.isrepo(dirpath):
+                repo = Repo().fromrepo(dirpath)
+                mtime = os.path.getmtime(os.path.join(dirpath, '.'+repo.scm.name))
+                data[self.key(dirpath)] = {'url': repo.url, 'scm': repo.scm.name, 'size': dirsize(dirpath),
+                                           'fetched': mtime, 'used': mtime}
+                dirs[:] = []
+        return data
+
+    @contextmanager
+    def update(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with (filelock(os.path.join(self.cache_dir, '.indexlock')) if fcntl else threadlock('cache_index', self.cache_dir)):
+            data = self.load()
+            if data is None:
+                data = self.scan()
+            yield data
+            fl = os.path.join(self.cache_dir, self.file)
+            try:
+                with open(fl + '.tmp', 'w') as f:
+                    json.dump(data, f, indent=4, sort_keys=True)
+                if os.name == 'nt' and os.path.exists(fl):
+                    os.remove(fl)
+                os.rename(fl + '.tmp', fl)
+            except (IOError, OSError):
+                warning("Unable to write cache index \"%s\"" % fl)
+
+    # Mirrors in the cache with their path, url, scm, size and last fetch and use times
+    def entries(self):
+        data = self.load()
+        if data is None:
+            if not os.path.isdir(self.cache_dir):
+                return []
+            with self.update() as data:
+                pass
+        return [dict(e, path=os.path.join(self.cache_dir, *k.split('/'))) for k, e in data.items()
+                if os.path.isdir(os.path.join(self.cache_dir, *k.split('/')))]
+
+    def fetched(self, path, url, scm):
+        with self.update() as data:
+            shared = data.get(self.key(path), {}).get('shared')
+            data[self.key(path)] = {'url': url, 'scm': scm, 'size': dirsize(path),
+                                    'fetched': time.time(), 'used': time.time()}
+            if shared:
+                data[self.key(path)]['shared'] = True
+
+    # Mirrors that clones in "share" cache mode borrow objects from are marked shared
+    def used(self, path, url, scm, shared=False):
+        try:
+            with self.update() as data:
+                if self.key(path) in data:
+                    data[self.key(path)]['used'] = time.time()
+                else:
+                    data[self.key(path)] = {'url': url, 'scm': scm, 'size': dirsize(path),
+                                            'fetched': os.path.getmtime(path), 'used': time.time()}
+                if shared:
+                    data[self.key(path)]['shared'] = True
+        except (IOError, OSError):
+            pass
+
+    def remove(self, path):
+        with self.update() as data:
+            data.pop(self.key(path), None)
+
+# Removes a mirror from the cache unless it's in use (readers and updates hold a shared lock)
+def cache_remove(mirror, cache_dir):
+    if not os.path.isdir(mirror['path']):
+        return False
+    if fcntl:
+        with filelock(os.path.join(mirror['path'], '.cachelock'), wait=False) as locked:
+            if not locked:
+                info("Skipping cached repository \"%s\" as it's in use" % mirror['url'])
+                return False
+            rmtree_readonly(mirror['path'])
+    else:
+        rmtree_readonly(mirror['path'])
+    CacheIndex(cache_dir).remove(mirror['path'])
+
+    # Remove the emptied parent directories (hosts and organizations)
+    path = os.path.dirname(mirror['path'])
+    while os.path.abspath(path).startswith(os.path.abspath(cache_dir) + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError:
+            break
+        path = os.path.dirname(path)
+    return True
+
+# Evicts the least recently used mirrors until the cache fits in limit bytes. The mirror keep
+# (usually the one just used) is never evicted
+def cache_gc(cache_dir, limit, keep=None):
+    if not os.path.isdir(cache_dir):
+        return
+    # Only one process evicts at a time, others skip it
+    with (filelock(os.path.join(cache_dir, '.gclock'), wait=False) if fcntl else threadlock('cache_gc')) as locked:
+        if locked is False:
+            return
+        mirrors = sorted(CacheIndex(cache_dir).entries(), key=lambda m: m['used'])
+        total = sum(m['size'] for m in mirrors)
+        for m in mirrors:
+            if total <= limit:
+                break
+            if keep and os.path.abspath(m['path']) == os.path.abspath(keep):
+                continue
+            if m.get('shared'):
+                # Clones in "share" cache mode would lose the objects they borrow
+                continue
+            if cache_remove(m, cache_dir):
+                info("Evicted cached repository \"%s\" (%s)" % (m['url'], sizeof_fmt(m['size'])))
+                total -= m['size']
+        return total
+
+# Warns that removing cached repositories breaks clones in "share" cache mode
+def cache_shared_warning(cache_dir, mode):
+    if mode == 'share' or any(m.get('shared') for m in CacheIndex(cache_dir).entries()):
+        warning("Repositories cloned in \"share\" cache mode borrow objects from the cache. Use \"git repack -a -d\" and remove \".git/objects/info/alternates\" in them before purging to keep them usable.")
+
+# Fetches repos and (if recursive) the libraries they reference at their revisions into the
+# cache, concurrently. Each repository is fetched once, and its libraries read once per revision.
+# Returns the paths of the cached repositories (without fetching, those already cached)
+def cache_warm(repos, recursive=True, jobs=1, fetch=True):
+    fetched = {}
+    seen = set()
+    lock = threading.Lock()
+
+    def warm(repo):
+        cpath = repo.url2cachedir(repo.url)
+        if not cpath or repo.is_local or repo.is_build:
+            return
+        with lock:
+            if (cpath, repo.rev) in seen:
+                return
+            seen.add((cpath, repo.rev))
+        with threadlock('warm', cpath):
+            if fetched.get(cpath) is False:
+                return
+            if fetch and cpath not in fetched:
+                action("Caching \"%s\"" % repo.url)
+            libs = repo.warm_cache(fetch=fetch and cpath not in fetched)
+            fetched[cpath] = bool(repo.scm)
+        for lib in libs if recursive else []:
+            work.put(warm, lib)
+
+    work = WorkQueue(jobs)
+    for repo in repos:
+        work.put(warm, repo)
+    work.join()
+    return sorted(cpath for cpath, v in fetched.items() if v)
+
+# Libraries of the program in the current directory, or those recorded in its lock file
+def cache_program_repos(locked=False):
+    program = Program(getcwd(), True)
+    if locked:
+        return [Repo.fromurl(lib['url'] + '#' + lib['rev'], os.path.join(program.path, lib['path'])) for lib in program.read_lock()]
+    return list(Repo.fromrepo(program.path).getlibs())
+
+# Writes the mirrors in paths (all cached repositories if None) to the archive fl as bundles, with
+# an index of their urls, scms and default branches. Returns the number of exported repositories
+def cache_export(fl, cache_dir, paths=None):
+    index = CacheIndex(cache_dir)
+    paths = set(os.path.normpath(p) for p in paths) if paths is not None else None
+    exported = {}
+    tmp = tempfile.mkdtemp()
+    try:
+        with tarfile.open(fl, 'w:gz' if re.search(r'\.t?gz$', fl) else 'w') as tar:
+            for e in sorted(index.entries(), key=lambda e: e['url']):
+                scm = scms.get(e['scm'])
+                if not hasattr(scm, 'cache_bundle') or (paths is not None and os.path.normpath(e['path']) not in paths):
+                    continue
+                key = index.key(e['path'])
+                bundle = os.path.join(tmp, scm.name + '.bundle')
+                repo = Repo.fromurl(e['url'])
+                try:
+                    with repo.cache_lock_held(repo.url, shared=True):
+                        with cd(e['path']):
+                            head = scm.cache_bundle(bundle)
+                except ProcessException:
+                    warning("Unable to export cached repository \"%s\"" % e['url'])
+                    continue
+                action("Exporting \"%s\" (%s)" % (e['url'], sizeof_fmt(os.path.getsize(bundle))))
+                tar.add(bundle, arcname=key + '/' + scm.name + '.bundle')
+                os.remove(bundle)
+                exported[key] = {'url': e['url'], 'scm': scm.name, 'head': head}
+
+            with open(os.path.join(tmp, index.file), 'w') as f:
+                json.dump(exported, f, indent=4, sort_keys=True)
+            tar.add(os.path.join(tmp, index.file), arcname=index.file)
+    except (IOError, OSError, tarfile.TarError) as e:
+        error("Unable to write cache archive \"%s\": %s" % (fl, e), 1)
+    finally:
+        rmtree_readonly(tmp)
+    return len(exported)
+
+# Populates the cache with the bundles in the archive fl written by cache_export(). Bundles of
+# repositories which are cached already are fetched into their mirrors. Returns the number of imported repositories
+def cache_import(fl, cache_dir):
+    imported = 0
+    tmp = tempfile.mkdtemp()
+    try:
+        with tarfile.open(fl, 'r:*') as tar:
+            try:
+                index = json.loads(tar.extractfile(CacheIndex.file).read().decode('utf-8'))
+            except (KeyError, ValueError):
+                error("\"%s\" is not a repository cache archive (see \"mbed cache export\")" % fl, 1)
+
+            for key, e in sorted(index.items()):
+                scm = scms.get(e.get('scm'))
+                repo = Repo.fromurl(e['url'])
+                cpath = repo.url2cachedir(repo.url)
+                if not hasattr(scm, 'cache_fetch') or not cpath or not os.path.abspath(cpath).startswith(os.path.abspath(cache_dir) + os.sep):
+                    warning("Skipping invalid cached repository \"%s\" in \"%s\"" % (e['url'], fl))
+                    continue
+                bundle = os.path.join(tmp, scm.name + '.bundle')
+                with open(bundle, 'wb') as f:
+                    shutil.copyfileobj(tar.extractfile(key + '/' + scm.name + '.bundle'), f)
+                action("Importing \"%s\" (%s)" % (e['url'], sizeof_fmt(os.path.getsize(bundle))))
+                try:
+                    with repo.cache_update_held(repo.url):
+                        repo.publish_cache(repo.url, scm, scm.cache_fetch, repo.url, bundle, e.get('head'))
+                    imported += 1
+                except ProcessException:
+                    warning("Unable to import cached repository \"%s\"" % e['url'])
+                finally:
+                    os.remove(bundle)
+    except (IOError, OSError, KeyError, tarfile.TarError) as e:
+        error("Unable to read cache archive \"%s\": %s" % (fl, e), 1)
+    finally:
+        rmtree_readonly(tmp)
+    return imported
+
+
 @subcommand('cache',
-    dict(name='on', nargs='?', help='Turn repository caching on. Will use either the default or the user specified cache directory.'),
-    dict(name='off', nargs='?', help='Turn repository caching off. Note that this doesn\'t purge cached repositories. See "purge".'),
-    dict(name='dir', nargs='?', help='Set cache directory. Set to "default" to let mbed CLI determine the cache directory location (%s/mbed-cache/).' % Global().path),
-    dict(name='ls', nargs='?', help='List cached repositories and their sizes.'),
-    dict(name='purge', nargs='?', help='Purge cached repositories. Note that this doesn\'t turn caching off'),
+    dict(name='cmd', metavar='command', nargs='?', help='Cache command, one of the commands listed above. Shows the cache status if omitted.'),
+    dict(name='args', metavar='argument', nargs='*', help='Argument of the command, e.g. the directory of "dir", or the repository URLs of "warm".'),
+    dict(name='--older-than', dest='older_than', help='Only purge repositories not used for the specified time, e.g. "30d", "12h" or "2w".'),
+    dict(name='--program', action='store_true', help='Only export the libraries of the current program and the libraries they reference, as cached.'),
+    dict(name='--locked', action='store_true', help='Only warm or export (with --program) the exact library revisions recorded in the "%s" file of the current program.' % lock_file_name),
+    dict(name=['-j', '--jobs'], type=int, help='Number of repositories to fetch in parallel when warming the cache. Default: 1 (or the "jobs" config value).'),
     help='Repository cache management\n\n',
     description=(
         "Repository cache management\n"
         "To minimize traffic and reduce import times, Mbed CLI can cache repositories by storing their indexes.\n"
-        "By default repository caching is turned on. Turn it off if you experience any problems.\n"))
-def cache_(on=False, off=False, dir=None, ls=False, purge=False, global_cfg=False):
-    cmd = str(on).lower()
-    argument = off
+        "By default repository caching is turned on. Turn it off if you experience any problems.\n\n"
+        "Commands:\n"
+        "  on                Turn repository caching on. Will use either the default or the user specified cache directory.\n"
+        "  off               Turn repository caching off. Note that this doesn't purge cached repositories. See \"purge\".\n"
+        "  dir <path>        Set cache directory. Set to \"default\" to let mbed CLI determine the cache directory location (%s/mbed-cache/).\n"
+        "  ls                List cached repositories and their sizes.\n"
+        "  purge [pattern]   Purge cached repositories, or only those whose URL matches the specified pattern (shell wildcards) and/or\n"
+        "                    which were not used for the time specified with --older-than. Note that this doesn't turn caching off.\n"
+        "  mode <mode>       Set how repositories cloned from the cache get their objects: \"copy\" (default) hardlinks them, \"share\"\n"
+        "                    borrows them from the cache (git alternates), \"dissociate\" borrows them during the clone and copies them afterwards.\n"
+        "  limit [size]      Set the size limit of the cache, e.g. \"10G\" (\"none\" for no limit). The least recently used repositories are\n"
+        "                    evicted when the cache exceeds it, except those that clones in \"share\" cache mode borrow objects from.\n"
+        "  gc                Evict the least recently used repositories until the cache fits in its size limit.\n"
+        "  warm [url ...]    Fetch the specified repository URLs, or all libraries of the current program, and the libraries they reference\n"
+        "                    into the cache, without creating working copies. Use before working offline or running parallel jobs.\n"
+        "  export <file>     Write the cached repositories to the specified archive file (bundles in a \".tar\" or \".tar.gz\" file), e.g. to\n"
+        "                    seed the cache of other machines.\n"
+        "  import <file>     Populate the cache from the specified archive file written by \"export\".\n") % Global().path)
+def cache_(cmd=False, args=None, older_than=None, program=False, locked=False, jobs=None, global_cfg=False):
+    cmd = str(cmd).lower()
+    # Arguments that follow options (e.g. "export --program <file>") are left to the remainder
+    args = (args or []) + [arg for arg in remainder if not arg.startswith('-')]
+    argument = args[0] if args else None
+    if len(args) > 1 and cmd != 'warm':
+        error("Too many arguments for \"%s\"." % cmd, 1)
     g = Global()
 
     cfg = g.cache_cfg()
@@ -3377,40 +5226,129 @@ def cache_(on=False, off=False, dir=None, ls=False, purge=False, global_cfg=Fals
         g.set_cfg('CACHE_DIR', argument)
         action('Repository cache location set to \"%s\"' % argument)
     elif cmd == 'ls':
-        def get_size_(path):
-            size = 0
-            for dirpath, dirs, files in os.walk(path):
-                for f in files:
-                    size += os.path.getsize(os.path.join(dirpath, f))
-            return size
         action("Listing cached repositories in \"%s\"" % cfg['cache_base'])
-        repos = []
         total_size = 0
-        for dirpath, dirs, files in os.walk(cfg['cache_dir']):
-            dirs[:] = [d for d in dirs  if not d.startswith('.')]
-            if Repo.isrepo(dirpath):
-                repo = Repo().fromrepo(dirpath)
-                url = repo.url
-                size = get_size_(repo.path)
-                total_size += size
-                log("* %s %s\n" % ('{:68}'.format(url), sizeof_fmt(size).rjust(8)))
-                for d in dirs:
-                    dirs.remove(d)
+        for m in sorted(CacheIndex(cfg['cache_dir']).entries(), key=lambda m: m['url']):
+            total_size += m['size']
+            log("* %s %s\n" % ('{:68}'.format(m['url']), sizeof_fmt(m['size']).rjust(8)))
         log(("-" * 79) + "\n")
         log("%s %s\n" % ('{:70}'.format('Total size:'), sizeof_fmt(total_size).rjust(8)))
+        if cfg['limit']:
+            log("%s %s\n" % ('{:70}'.format('Size limit:'), sizeof_fmt(cfg['limit']).rjust(8)))
+    elif cmd == 'mode':
+        if argument not in cache_modes:
+            error("Please specify cache mode. Supported: %s" % ', '.join(cache_modes), 1)
+        g.set_cfg('CACHE_MODE', argument)
+        action("Repository cache mode is now \"%s\"." % argument)
     elif cmd == 'purge':
-        action("Purging cached repositories in \"%s\"..." % cfg['cache_base'])
-        if os.path.isdir(cfg['cache_dir']):
-            rmtree_readonly(cfg['cache_dir'])
+        cache_shared_warning(cfg['cache_dir'], cfg['mode'])
+        if argument or older_than:
+            age = parse_age(older_than) if older_than else 0
+            if age is None:
+                error("Invalid age \"%s\". Please specify e.g. \"30d\", \"12h\" or \"2w\"." % older_than, 1)
+            action("Purging cached repositories%s%s in \"%s\"..." % (
+                (" matching \"%s\"" % argument) if argument else "",
+                (" not used for %s" % older_than) if older_than else "", cfg['cache_base']))
+            for m in CacheIndex(cfg['cache_dir']).entries():
+                if argument and not fnmatch.fnmatch(m['url'], '*%s*' % argument):
+                    continue
+                if age and m['used'] > time.time() - age:
+                    continue
+                if cache_remove(m, cfg['cache_dir']):
+                    action("Purged \"%s\" (%s)" % (m['url'], sizeof_fmt(m['size'])))
+        else:
+            action("Purging cached repositories in \"%s\"..." % cfg['cache_base'])
+            if os.path.isdir(cfg['cache_dir']):
+                rmtree_readonly(cfg['cache_dir'])
         action("Purge complete!")
+    elif cmd == 'limit':
+        if argument:
+            if argument.lower() in ['none', 'off', '0']:
+                g.set_cfg('CACHE_LIMIT', None)
+                action("Repository cache size limit is now removed.")
+            elif not parse_size(argument):
+                error("Invalid size \"%s\". Please specify e.g. \"500M\" or \"10G\"." % argument, 1)
+            else:
+                g.set_cfg('CACHE_LIMIT', argument)
+                action("Repository cache size limit is now %s." % sizeof_fmt(parse_size(argument)))
+        else:
+            action("Repository cache size limit is %s." % (sizeof_fmt(cfg['limit']) if cfg['limit'] else "not set"))
+    elif cmd == 'warm':
+        if cfg['cache'] != 'enabled':
+            error("Repository cache is disabled. Please see \"mbed cache on\".", 1)
+        repos = [Repo.fromurl(url) for url in args] if args else cache_program_repos(locked)
+        action("Warming the repository cache in \"%s\"..." % cfg['cache_base'])
+        count = len(cache_warm(repos, recursive=not locked, jobs=getjobs(jobs)))
+        action("Cached %d repositories." % count)
+        if cfg['limit'] and sum(m['size'] for m in CacheIndex(cfg['cache_dir']).entries()) > cfg['limit']:
+            warning("The repository cache exceeds its size limit (%s), so the least recently used repositories will be evicted by the next clone or \"mbed cache gc\"." % sizeof_fmt(cfg['limit']))
+    elif cmd == 'export':
+        if not argument:
+            error("Please specify the archive file to export the cache to.", 1)
+        paths = None
+        if program:
+            # The libraries of the program as cached, without fetching them
+            paths = cache_warm(cache_program_repos(locked), recursive=not locked, jobs=getjobs(jobs), fetch=False)
+        action("Exporting cached repositories in \"%s\" to \"%s\"..." % (cfg['cache_base'], argument))
+        count = cache_export(argument, cfg['cache_dir'], paths)
+        action("Exported %d repositories." % count)
+    elif cmd == 'import':
+        if cfg['cache'] != 'enabled':
+            error("Repository cache is disabled. Please see \"mbed cache on\".", 1)
+        if not argument or not os.path.isfile(argument):
+            error("Please specify the archive file to import to the cache (see \"mbed cache export\").", 1)
+        action("Importing cached repositories from \"%s\" to \"%s\"..." % (argument, cfg['cache_base']))
+        count = cache_import(argument, cfg['cache_dir'])
+        action("Imported %d repositories." % count)
+    elif cmd == 'gc':
+        if not cfg['limit']:
+            error("Repository cache size limit is not set. Please see \"mbed cache limit\".", 1)
+        cache_shared_warning(cfg['cache_dir'], cfg['mode'])
+        action("Evicting least recently used repositories to fit the cache in %s..." % sizeof_fmt(cfg['limit']))
+        total = cache_gc(cfg['cache_dir'], cfg['limit'])
+        action("Cache size is now %s." % sizeof_fmt(total or 0))
     elif cmd == "false":
         action("Repository cache is %s." % str(cfg['cache']).upper())
         action("Cache location \"%s\"" % cfg['cache_dir'])
+        action("Cache mode \"%s\"" % cfg['mode'])
+        if cfg['limit']:
+            action("Cache size limit %s" % sizeof_fmt(cfg['limit']))
     else:
         print(cmd)
         error("Invalid cache command. Please see \"mbed cache --help\" for valid commands.")
 
 
+@subcommand('sparse',
+    dict(name='cmd', nargs='?', help='Command. "on" or "off" to turn sparse checkout of mbed OS on or off, "refresh" to update the checked out target directories.'),
+    dict(name=['-G', '--global'], dest='global_cfg', action='store_true', help='Use global settings, not local'),
+    help='Sparse checkout of mbed OS\n\n',
+    description=(
+        "Sparse checkout of mbed OS\n"
+        "When turned on, mbed OS is cloned without file contents (partial clone) and only the\n"
+        "target directories (TARGET_*) of the configured target are checked out.\n"
+        "Changing the target with \"mbed target\" updates the checked out directories.\n"
+        "Use \"refresh\" to update them manually, e.g. after \"mbed update\"."))
+def sparse_(cmd=None, global_cfg=False):
+    program = Program(getcwd())
+    if program.is_cwd and not global_cfg:
+        error(
+            "Could not find mbed program in current path \"%s\".\n"
+            "Change the current directory to a valid mbed program or use the '--global' option to set global configuration." % program.path)
+
+    if cmd == 'on' or cmd == 'off':
+        (Global() if global_cfg else program).set_cfg('SPARSE', 'enabled' if cmd == 'on' else 'disabled')
+        action("Sparse checkout of mbed OS is now %s." % ('ENABLED' if cmd == 'on' else 'DISABLED'))
+        if cmd == 'on' and not program.get_sparse_target():
+            warning("No target is set. Use \"mbed target\" to set the target to check out.")
+    elif cmd != 'refresh' and cmd is not None:
+        error("Invalid sparse command. Please see \"mbed sparse --help\" for valid commands.")
+
+    if cmd is None:
+        action("Sparse checkout of mbed OS is %s." % ('ENABLED' if program.get_cfg('SPARSE') == 'enabled' else 'DISABLED'))
+    elif not program.is_cwd and not program.refresh_sparse():
+        warning("Unable to find mbed OS (Git) in program \"%s\"" % program.name)
+
+
 @subcommand('help',
     help='This help screen')
 def help_():
@@ -3440,7 +5378,7 @@ def main():
     verbose = very_verbose or pargs.verbose
     try:
         pathtype = Repo.pathtype(cwd_root)
-        if not sys.argv[1].lower() in skip_workpath_commands:
+        if not sys.argv[1].lower() in skip_workpath_commands and not getattr(pargs, 'plan', False): # keep JSON output clean
             action('Working path \"%s\" (%s)' % (cwd_root, pathtype))
             if pathtype == "library":
                 action('Program path \"%s\"' % Program(cwd_root).path)
@@ -3462,11 +5400,15 @@ def main():
             error('OS Error: %s' % e.args[1], e.args[0])
     except KeyboardInterrupt:
         info('User aborted!', -1)
+        if journal:
+            info('Run the command again to resume it', -1)
         sys.exit(255)
     except Exception as e:
         if very_verbose:
             traceback.print_exc(file=sys.stdout)
         error("Unknown Error: %s" % e, 255)
+    finally:
+        ssh_mux.close()
 
     sys.exit(status or 0)
 
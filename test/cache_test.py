@@ -0,0 +1,207 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+from util import *
+import json
+
+# Cached repositories by URL, from the cache index
+def mirrors(cache):
+    with open(os.path.join(cache, 'index.json')) as f:
+        return dict((e['url'], os.path.join(cache, *key.split('/'))) for key, e in json.load(f).items())
+
+# Adds a reference to the library url to the git repository repo
+def addlib(repo, name, url):
+    popen(['git', 'clone', repo, 'work'])
+    with cd('work'):
+        with open(name + '.lib', 'w') as f:
+            f.write(url + '/\n')
+        mkcommit(files=[name + '.lib'])
+    remove('work')
+
+def cacheimport(mbed, url, path):
+    return pquery(['python', mbed, 'import', url, path, '--insecure', '-v'])
+
+# Tests if a repository is cloned from the cache in each cache mode
+@pytest.mark.parametrize('mode', ['copy', 'share', 'dissociate'])
+def test_cache_mode(mbed, cache, mode):
+    url = fileurl(mkgit('test1'))
+    popen(['python', mbed, 'cache', 'mode', mode])
+
+    cacheimport(mbed, url, 'testimport1')
+    assert os.path.isdir(os.path.join(mirrors(cache)[url], '.git'))
+
+    out = cacheimport(mbed, url, 'testimport2')
+    assert 'Cloning cached repository' in out
+    assert os.path.isfile('testimport2/test')
+    with cd('testimport2'):
+        assert pquery(['git', 'config', '--get', 'remote.origin.url']).strip() == url
+        popen(['git', 'fsck'])
+    assert os.path.isfile('testimport2/.git/objects/info/alternates') == (mode == 'share')
+
+# Tests if the cached repository is updated with the revisions fetched by clones from the cache
+def test_cache_refresh(mbed, cache):
+    test1 = mkgit('test1')
+    url = fileurl(test1)
+    cacheimport(mbed, url, 'testimport1')
+
+    popen(['git', 'clone', test1, 'test1'])
+    with cd('test1'):
+        with open('hello', 'w') as f:
+            f.write('hello\n')
+        mkcommit(files=['hello'])
+        rev = pquery(['git', 'rev-parse', 'HEAD']).strip()
+
+    out = cacheimport(mbed, url, 'testimport2')
+    assert 'Cloning cached repository' in out
+    assert os.path.isfile('testimport2/hello')
+    with cd(mirrors(cache)[url]):
+        assert pquery(['git', 'rev-parse', 'HEAD']).strip() == rev
+
+# Tests if Mercurial repositories cloned from the cache use the remote repository
+def test_cache_hg(mbed, cache):
+    url = fileurl(mkhg('test1'))
+    cacheimport(mbed, url, 'testimport1')
+    assert os.path.isdir(os.path.join(mirrors(cache)[url], '.hg'))
+
+    out = cacheimport(mbed, url, 'testimport2')
+    assert 'Cloning cached repository' in out
+    assert os.path.isfile('testimport2/test')
+    with cd('testimport2'):
+        assert pquery(['hg', 'paths', 'default']).strip() == url
+
+# Tests if the least recently used repositories are evicted when the cache exceeds its size limit
+def test_cache_limit(mbed, cache):
+    url1, url2 = fileurl(mkgit('test1')), fileurl(mkgit('test2'))
+    popen(['python', mbed, 'cache', 'limit', '1K'])
+
+    cacheimport(mbed, url1, 'testimport1')
+    path1 = mirrors(cache)[url1]
+    cacheimport(mbed, url2, 'testimport2')
+
+    assert list(mirrors(cache)) == [url2]
+    assert not os.path.exists(path1)
+
+# Tests if repositories that clones in "share" cache mode borrow objects from are never evicted
+def test_cache_limit_share(mbed, cache):
+    url1, url2 = fileurl(mkgit('test1')), fileurl(mkgit('test2'))
+    popen(['python', mbed, 'cache', 'mode', 'share'])
+    popen(['python', mbed, 'cache', 'limit', '1K'])
+
+    cacheimport(mbed, url1, 'testimport1')
+    cacheimport(mbed, url1, 'testshared')
+    cacheimport(mbed, url2, 'testimport2')
+    out = subprocess.check_output(['python', mbed, 'cache', 'gc'], stderr=subprocess.STDOUT).decode('utf-8')
+
+    assert 'borrow objects from the cache' in out
+    assert list(mirrors(cache)) == [url1]
+    with cd('testshared'):
+        popen(['git', 'fsck'])
+
+# Tests if only the cached repositories that match the pattern are purged
+def test_cache_purge(mbed, cache):
+    url1, url2 = fileurl(mkgit('test1')), fileurl(mkgit('test2'))
+    cacheimport(mbed, url1, 'testimport1')
+    cacheimport(mbed, url2, 'testimport2')
+
+    popen(['python', mbed, 'cache', 'purge', 'test1'])
+
+    assert list(mirrors(cache)) == [url2]
+
+# Tests if the cache index records the repositories with their URLs, and is rebuilt when missing
+def test_cache_index(mbed, cache):
+    url = fileurl(mkgit('test1'))
+    cacheimport(mbed, url, 'testimport1')
+
+    with open(os.path.join(cache, 'index.json')) as f:
+        entry = list(json.load(f).values())[0]
+    assert entry['url'] == url
+    assert entry['scm'] == 'git'
+    assert entry['size'] > 0
+
+    cacheimport(mbed, url, 'testimport2')
+    with open(os.path.join(cache, 'index.json')) as f:
+        assert list(json.load(f).values())[0]['used'] > entry['used']
+
+    os.remove(os.path.join(cache, 'index.json'))
+    out = pquery(['python', mbed, 'cache', 'ls'])
+    assert url in out
+    assert list(mirrors(cache)) == [url]
+
+# Tests if 'mbed update --plan' finds cached libraries without recording their use
+def test_cache_plan(mbed, cache):
+    test1, url2 = mkgit('test1'), fileurl(mkgit('test2'))
+    popen(['git', 'clone', test1, 'test1'])
+    with cd('test1'):
+        with open('test2.lib', 'w') as f:
+            f.write(url2 + '/\n')
+        mkcommit(files=['test2.lib'])
+    cacheimport(mbed, fileurl(test1), 'testimport')
+    remove('testimport/test2')
+
+    with open(os.path.join(cache, 'index.json')) as f:
+        index = f.read()
+    with cd('testimport'):
+        plan = json.loads(pquery(['python', mbed, 'update', '--plan']))
+
+    assert [entry['cost'] for entry in plan['actions'] if entry['action'] == 'clone'] == ['local']
+    with open(os.path.join(cache, 'index.json')) as f:
+        assert f.read() == index
+
+# Tests if 'mbed cache warm' caches all the specified repositories
+def test_cache_warm(mbed, cache):
+    urls = [fileurl(mkgit('test%d' % i)) for i in range(12)]
+    popen(['python', mbed, 'cache', 'warm'] + urls)
+
+    assert sorted(mirrors(cache)) == sorted(urls)
+    out = cacheimport(mbed, urls[-1], 'testimport')
+    assert 'Cloning cached repository' in out
+
+# Tests if 'mbed cache warm' caches the libraries of the program and the libraries they reference
+def test_cache_warm_program(mbed, cache):
+    test1, test2, url3 = mkgit('test1'), mkgit('test2'), fileurl(mkgit('test3'))
+    addlib(test2, 'test3', url3)
+    addlib(test1, 'test2', fileurl(test2))
+    popen(['git', 'clone', test1, 'test1'])
+
+    with cd('test1'):
+        popen(['python', mbed, 'cache', 'warm', '-j', '2'])
+
+    assert sorted(mirrors(cache)) == sorted([fileurl(test2), url3])
+
+# Tests if the cache exported to an archive is restored by importing it
+def test_cache_export_import(mbed, cache):
+    url1, url2 = fileurl(mkgit('test1')), fileurl(mkhg('test2'))
+    popen(['python', mbed, 'cache', 'warm', url1, url2])
+    popen(['python', mbed, 'cache', 'export', 'cache.tar.gz'])
+    popen(['python', mbed, 'cache', 'purge'])
+
+    popen(['python', mbed, 'cache', 'import', 'cache.tar.gz'])
+
+    assert sorted(mirrors(cache)) == sorted([url1, url2])
+    popen(['python', mbed, 'import', url1, 'testimport1', '--insecure', '--offline'])
+    popen(['python', mbed, 'import', url2, 'testimport2', '--insecure', '--offline'])
+    assert os.path.isfile('testimport1/test')
+    assert os.path.isfile('testimport2/test')
+
+# Tests if 'mbed cache export --program' only exports the libraries of the program
+def test_cache_export_program(mbed, cache):
+    test1, url2, url3 = mkgit('test1'), fileurl(mkgit('test2')), fileurl(mkgit('test3'))
+    addlib(test1, 'test2', url2)
+    popen(['git', 'clone', test1, 'test1'])
+    popen(['python', mbed, 'cache', 'warm', url2, url3])
+
+    with cd('test1'):
+        popen(['python', mbed, 'cache', 'export', '--program', os.path.join('..', 'cache.tar')])
+    popen(['python', mbed, 'cache', 'purge'])
+    popen(['python', mbed, 'cache', 'import', 'cache.tar'])
+
+    assert list(mirrors(cache)) == [url2]
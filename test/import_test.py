@@ -24,3 +24,147 @@ def test_import(mbed, testrepos):
         "   `- test3",
         "      `- test4",
     ])
+
+# Tests 'mbed import' with libraries cloned in parallel
+def test_import_jobs(mbed, testrepos):
+    test1 = testrepos[0]
+    popen(['python', mbed, 'import', test1, 'testimport', '-j', '4'])
+
+    assertls(mbed, 'testimport', [
+        "[mbed]",
+        "testimport",
+        "`- test2",
+        "   `- test3",
+        "      `- test4",
+    ])
+
+def test_import_depth(mbed, testrepos):
+    test1 = testrepos[0]
+    popen(['python', mbed, 'import', test1, 'testimport', '--depth', '1'])
+
+    assertls(mbed, 'testimport', [
+        "[mbed]",
+        "testimport",
+        "`- test2",
+        "   `- test3",
+        "      `- test4",
+    ])
+
+# Tests if every library is cloned with its SCM, without trying the other SCMs first
+def test_import_scm(mbed, testrepos):
+    test1 = testrepos[0]
+    out = pquery(['python', mbed, 'import', test1, 'testimport', '-v'])
+
+    clones = [line for line in out.splitlines() if re.search(r'Exec "(git|hg) clone', line)]
+    assert len(clones) == 4
+
+# Tests if a library referenced with different revisions is reported, and its second copy is cloned from the first
+def test_import_conflict(mbed):
+    test1, test2, test3 = mkgit('test1'), mkgit('test2'), mkgit('test3')
+    popen(['git', 'clone', test3, 'test3'])
+    with cd('test3'):
+        rev1 = pquery(['git', 'rev-parse', 'HEAD']).strip()
+        with open('hello', 'w') as f:
+            f.write('hello\n')
+        mkcommit(files=['hello'])
+        rev2 = pquery(['git', 'rev-parse', 'HEAD']).strip()
+
+    for repo, libs in [(test2, {'test3': rev2}), (test1, {'test2': '', 'test3': rev1})]:
+        popen(['git', 'clone', repo, 'work'])
+        with cd('work'):
+            for name, rev in libs.items():
+                with open(name + '.lib', 'w') as f:
+                    f.write({'test2': test2, 'test3': test3}[name] + '/' + ('#' + rev if rev else '') + '\n')
+            mkcommit(files=[name + '.lib' for name in libs])
+        remove('work')
+
+    out = subprocess.check_output(['python', mbed, 'import', test1, 'testimport', '-v'],
+                                  stderr=subprocess.STDOUT).decode('utf-8')
+
+    assert 'is referenced with conflicting revisions' in out
+    assert 'Found local copy of the repository' in out
+    assert not os.path.isfile(os.path.join('testimport', 'test3', 'hello'))
+    assert os.path.isfile(os.path.join('testimport', 'test2', 'test3', 'hello'))
+
+# Tests if an interrupted 'mbed import' is resumed instead of failing on the non-empty directory
+def test_import_resume(mbed, testrepos):
+    test1 = testrepos[0]
+    popen(['python', mbed, 'import', test1, 'testimport'])
+
+    # Simulate an interruption while test2 was checked out
+    with cd('testimport'):
+        with open('.mbed_journal', 'w') as f:
+            f.write('clone - .\nstart - test2\n')
+        remove(os.path.join('test2', 'test3'))
+        os.remove(os.path.join('test2', 'test3.lib'))
+
+    popen(['python', mbed, 'import', test1, 'testimport'])
+
+    assertls(mbed, 'testimport', [
+        "[mbed]",
+        "testimport",
+        "`- test2",
+        "   `- test3",
+        "      `- test4",
+    ])
+    assert not os.path.exists(os.path.join('testimport', '.mbed_journal'))
+
+# Tests if an interrupted import isn't resumed when importing another program to its directory
+def test_import_resume_other(mbed, testrepos):
+    test1, test2 = testrepos[0], testrepos[1]
+    popen(['python', mbed, 'import', test1, 'testimport'])
+    with cd('testimport'):
+        with open('.mbed_journal', 'w') as f:
+            f.write('clone - .\nstart - test2\n')
+
+    with pytest.raises(ProcessException):
+        popen(['python', mbed, 'import', test2, 'testimport'])
+
+    assert os.path.isfile(os.path.join('testimport', 'test2.lib'))
+
+# Tests if a failing library in a parallel import doesn't leave partial clones behind
+def test_import_jobs_error(mbed, testrepos):
+    test1 = testrepos[0]
+    with cd('test1'):
+        with open('bad.lib', 'w') as f:
+            f.write(os.path.abspath('../nonexistent') + '/\n')
+        mkcommit(files=['bad.lib'])
+
+    with pytest.raises(ProcessException):
+        popen(['python', mbed, 'import', test1, 'testimport', '-j', '4'])
+
+    assert not os.path.exists('testimport/bad')
+
+# Tests if git commands over ssh share connections, using an ssh command that runs the remote command locally
+@pytest.mark.skipif(os.name == 'nt', reason='ssh connection sharing is not used on Windows')
+def test_import_ssh_mux(mbed, tmpdir, monkeypatch):
+    test1 = mkgit('test1')
+    bindir = tmpdir.mkdir('bin')
+    with open(str(bindir.join('ssh')), 'w') as f:
+        f.write(
+            '#!/bin/sh\n'
+            'echo "$@" >> "%s"\n'
+            'while [ $# -gt 0 ]; do\n'
+            '    case "$1" in\n'
+            '        -O|-G) exit 0;;\n'
+            '        -o|-p) shift 2;;\n'
+            '        -*) shift;;\n'
+            '        *) break;;\n'
+            '    esac\n'
+            'done\n'
+            'shift\n'
+            'exec sh -c "$*"\n' % tmpdir.join('ssh.log'))
+    os.chmod(str(bindir.join('ssh')), 0o755)
+    monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.delenv('GIT_SSH', raising=False)
+    monkeypatch.delenv('GIT_SSH_COMMAND', raising=False)
+
+    popen(['python', mbed, 'import', 'ssh://localhost' + test1, 'testimport'])
+
+    assert os.path.isfile('testimport/test')
+    with open(str(tmpdir.join('ssh.log'))) as f:
+        log = f.read()
+    assert 'ControlMaster=auto' in log
+    # The connections and their directory are closed on exit
+    control = re.search(r'ControlPath=(\S+)', log).group(1)
+    assert not os.path.exists(os.path.dirname(control))
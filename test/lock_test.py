@@ -0,0 +1,81 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, 
+# either express or implied.
+
+import json
+
+from util import *
+
+# Tests if 'mbed update --write-lock' records all libraries
+def test_write_lock(mbed, testrepos):
+    test1 = testrepos[0]
+    popen(['python', mbed, 'import', test1, 'testimport'])
+
+    with cd('testimport'):
+        popen(['python', mbed, 'update', '--write-lock'])
+
+    with open(os.path.join('testimport', 'mbed.lock')) as f:
+        libs = json.load(f)['libraries']
+
+    assert [lib['path'] for lib in libs] == ['test2', 'test2/test3', 'test2/test3/test4']
+    assert [lib['url'] for lib in libs] == list(testrepos[1:])
+
+# Tests if 'mbed deploy --locked' restores the locked libraries
+def test_deploy_locked(mbed, testrepos):
+    test_write_lock(mbed, testrepos)
+
+    remove(os.path.join('testimport', 'test2'))
+    with cd('testimport'):
+        popen(['python', mbed, 'deploy', '--locked', '-j', '2'])
+
+    assertls(mbed, 'testimport', [
+        "[mbed]",
+        "testimport",
+        "`- test2",
+        "   `- test3",
+        "      `- test4",
+    ])
+
+# Tests if 'mbed deploy --locked' keeps uncommitted changes in libraries at another revision
+def test_deploy_locked_changes(mbed, testrepos):
+    test_write_lock(mbed, testrepos)
+
+    with cd(os.path.join('testimport', 'test2')):
+        with open('hello', 'w') as f:
+            f.write('hello\n')
+        popen([scm(), 'add', 'hello'])
+        popen([scm(), 'commit', '-m', 'test commit'])
+        with open('test', 'w') as f:
+            f.write('changed\n')
+
+    with cd('testimport'):
+        with pytest.raises(ProcessException):
+            popen(['python', mbed, 'deploy', '--locked'])
+
+    with open(os.path.join('testimport', 'test2', 'test')) as f:
+        assert f.read() == 'changed\n'
+
+# Tests if 'mbed deploy --locked' refuses insecure repository URLs without --insecure
+def test_deploy_locked_insecure(mbed, testrepos):
+    test_write_lock(mbed, testrepos)
+
+    with open(os.path.join('testimport', 'mbed.lock')) as f:
+        lock = json.load(f)
+    lock['libraries'][0]['url'] = 'https://localhost:8443/test2'
+    with open(os.path.join('testimport', 'mbed.lock'), 'w') as f:
+        json.dump(lock, f)
+    remove(os.path.join('testimport', 'test2'))
+
+    with cd('testimport'):
+        with pytest.raises(ProcessException):
+            popen(['python', mbed, 'deploy', '--locked'])
+
+    assert not os.path.exists(os.path.join('testimport', 'test2'))
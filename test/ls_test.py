@@ -21,3 +21,11 @@ def test_ls(mbed, testrepos):
         "   `- test3",
         "      `- test4",
     ])
+
+# Tests that parallel queries print the same tree as sequential ones
+def test_ls_jobs(mbed, testrepos):
+    with cd('test1'):
+        serial = pquery(['python', mbed, 'ls', '-a', '-j', '1'])
+        parallel = pquery(['python', mbed, 'ls', '-a', '-j', '4'])
+
+    assert serial == parallel
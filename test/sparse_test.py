@@ -0,0 +1,86 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+from util import *
+import json
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mbed import mbed as mbedcli
+
+TARGETS = {
+    'BOARD': {'inherits': ['FAMILY'], 'extra_labels_add': ['RADIO']},
+    'FAMILY': {'extra_labels': ['MCU']},
+    'OTHER': {},
+}
+
+# Tests if the patterns check out the directories of the target, its parents and their labels
+def test_sparse_patterns():
+    assert mbedcli.sparse_patterns(TARGETS, 'BOARD') == [
+        '/*', '!/targets/**/TARGET_*/',
+        '/targets/**/TARGET_BOARD/', '/targets/**/TARGET_FAMILY/',
+        '/targets/**/TARGET_MCU/', '/targets/**/TARGET_RADIO/']
+    assert mbedcli.sparse_patterns(TARGETS, 'UNKNOWN') is None
+
+# Creates a repository with the target directories of mbed OS
+def mkmbedos():
+    os.mkdir('mbed-os')
+    with cd('mbed-os'):
+        popen(['git', 'init'])
+        for label in ['BOARD', 'FAMILY', 'MCU', 'RADIO', 'OTHER']:
+            os.makedirs(os.path.join('targets', 'TARGET_' + label))
+            with open(os.path.join('targets', 'TARGET_' + label, 'test'), 'w') as f:
+                f.write(label)
+        with open(os.path.join('targets', 'targets.json'), 'w') as f:
+            json.dump(TARGETS, f)
+        popen(['git', 'add', 'targets'])
+        popen(['git', 'commit', '-m', 'test commit'])
+    mbedos = os.path.abspath('mbed-os.git').replace('\\', '/')
+    popen(['git', 'clone', '--bare', 'mbed-os', mbedos])
+    remove('mbed-os')
+    return mbedos
+
+# Tests if mbed OS is cloned without the directories of other targets when sparse checkout is on
+def test_sparse_import(mbed):
+    mbedos = mkmbedos()
+    popen(['python', mbed, 'new', 'testprogram', '--create-only'])
+    with cd('testprogram'):
+        popen(['python', mbed, 'config', 'target', 'BOARD'])
+        popen(['python', mbed, 'sparse', 'on'])
+        popen(['python', mbed, 'add', mbedos, 'mbed-os'])
+
+    targets = os.path.join('testprogram', 'mbed-os', 'targets')
+    for label in ['BOARD', 'FAMILY', 'MCU', 'RADIO']:
+        assert os.path.isfile(os.path.join(targets, 'TARGET_' + label, 'test'))
+    assert not os.path.exists(os.path.join(targets, 'TARGET_OTHER'))
+    assert os.path.isfile(os.path.join(targets, 'targets.json'))
+
+    # Changing the target updates the checked out directories
+    with cd('testprogram'):
+        popen(['python', mbed, 'config', 'target', 'OTHER'])
+    assert os.path.isfile(os.path.join(targets, 'TARGET_OTHER', 'test'))
+    assert not os.path.exists(os.path.join(targets, 'TARGET_BOARD'))
+
+# Tests if the partial clone of mbed OS for sparse checkout isn't cached, which would fetch all file contents
+def test_sparse_import_cache(mbed, cache):
+    mbedos = mkmbedos()
+    with cd(mbedos):
+        popen(['git', 'config', 'uploadpack.allowFilter', 'true'])
+    popen(['python', mbed, 'new', 'testprogram', '--create-only'])
+    with cd('testprogram'):
+        popen(['python', mbed, 'config', 'target', 'BOARD'])
+        popen(['python', mbed, 'sparse', 'on'])
+        out = pquery(['python', mbed, 'add', fileurl(mbedos), 'mbed-os', '--insecure', '-v'])
+
+    assert 'Not caching partial clone' in out
+    assert not os.path.exists(os.path.join('testprogram', 'mbed-os', 'targets', 'TARGET_OTHER'))
+    assert not [path for path, dirs, files in os.walk(cache) if '.git' in dirs]
@@ -11,6 +11,7 @@
 # either express or implied.
 
 from util import *
+import json
 
 # Tests if a 'mbed sync', commit, and 'mbed update' works on a simple file change
 def test_sync_update(mbed, testrepos):
@@ -108,3 +109,136 @@ def test_sync_update_move(mbed, testrepos):
         "      `- test4",
     ])
 
+
+# Tests if 'mbed update' with parallel fetching carries over changes in nested libraries
+def test_sync_update_jobs(mbed, testrepos):
+    test1 = testrepos[0]
+    popen(['python', mbed, 'import', test1, 'testimport', '-vv'])
+
+    with cd('test1/test2/test3'):
+        with open('hello', 'w') as f:
+            f.write('hello\n')
+        popen([scm(), 'add', 'hello'])
+        mkcommit()
+
+    with cd('test1/test2'):
+        popen(['python', mbed, 'sync', '-vv'])
+        mkcommit()
+
+    with cd('test1'):
+        popen(['python', mbed, 'sync', '-vv'])
+        mkcommit()
+
+    with cd('testimport'):
+        popen(['python', mbed, 'update', '-j', '4', '-vv'])
+
+    assert os.path.isfile('testimport/test2/test3/hello')
+
+# Tests if 'mbed update' to a revision that is already available locally doesn't need the remote repository
+def test_update_local_rev(mbed, testrepos):
+    test1 = testrepos[0]
+    popen(['python', mbed, 'import', test1, 'testimport', '-vv'])
+
+    with cd('testimport'):
+        if scm() == 'git':
+            rev = pquery(['git', 'rev-parse', 'HEAD']).strip()
+        else:
+            rev = pquery(['hg', 'id', '-i', '--debug']).strip()
+
+    for repo in testrepos:
+        move(repo, repo + '.moved')
+
+    with cd('testimport'):
+        popen(['python', mbed, 'update', rev, '-vv'])
+
+# Tests if 'mbed update --plan' reports the actions without changing anything
+def test_update_plan(mbed, testrepos):
+    test1 = testrepos[0]
+    popen(['python', mbed, 'import', test1, 'testimport', '-vv'])
+
+    with cd('testimport/test2'):
+        remove('test3')
+
+    with cd('testimport'):
+        plan = json.loads(pquery(['python', mbed, 'update', '--plan']))
+
+    actions = dict((entry['path'], entry['action']) for entry in plan['actions'])
+    assert actions['.'] == 'fetch'
+    assert actions['test2'] == 'uptodate'
+    assert actions[os.path.join('test2', 'test3')] == 'clone'
+    assert not os.path.exists('testimport/test2/test3')
+
+# Tests if 'mbed publish' with parallel pushes publishes libraries before the repositories that reference them
+def test_publish_jobs(mbed, testrepos):
+    test1 = testrepos[0]
+
+    with cd('test1/test2/test3/test4'):
+        with open('hello', 'w') as f:
+            f.write('hello\n')
+        popen([scm(), 'add', 'hello'])
+
+    with cd('test1'):
+        out = pquery(['python', mbed, 'publish', '-M', 'test commit', '-j', '4'])
+
+    pushes = re.findall(r'Pushing local repository "(\w+)"', out)
+    assert pushes == ['test4', 'test3', 'test2', 'test1']
+
+    popen(['python', mbed, 'import', test1, 'testimport', '-vv'])
+    assert os.path.isfile('testimport/test2/test3/test4/hello')
+
+# Tests if 'mbed sync' with parallel library subtrees updates the references in every subtree
+def test_sync_jobs(mbed, testrepos):
+    with cd('test1/test2'):
+        copy('test3', 'testcopy')
+    with cd('test1/test2/test3'):
+        copy('test4', 'test4copy')
+
+    with cd('test1'):
+        popen(['python', mbed, 'sync', '-j', '4', '-vv'])
+
+    assert os.path.isfile('test1/test2/testcopy.lib')
+    assert os.path.isfile('test1/test2/test3/test4copy.lib')
+    assertls(mbed, 'test1', [
+        "[mbed]",
+        "test1",
+        "`- test2",
+        "   |- test3",
+        "   |  |- test4",
+        "   |  `- test4copy",
+        "   `- testcopy",
+        "      `- test4",
+    ])
+
+# Tests if 'mbed update' with parallel fetching fetches the libraries pinned to new revisions before updating
+def test_update_jobs_prefetch(mbed, testrepos):
+    test1 = testrepos[0]
+    popen(['python', mbed, 'import', test1, 'testimport'])
+
+    with cd('test1/test2/test3/test4'):
+        with open('hello', 'w') as f:
+            f.write('hello\n')
+        popen([scm(), 'add', 'hello'])
+        mkcommit()
+
+    for path in ['test1/test2/test3', 'test1/test2', 'test1']:
+        with cd(path):
+            popen(['python', mbed, 'sync'])
+            mkcommit()
+
+    with cd('testimport'):
+        out = pquery(['python', mbed, 'update', '-j', '4', '-v'])
+
+    assert os.path.isfile('testimport/test2/test3/test4/hello')
+    updates = out[out.index('Updating program'):]
+    assert not re.search(r'Exec "(git fetch|hg pull)', updates)
+
+# Tests if 'mbed deploy' on an up-to-date tree doesn't fetch or check out any library
+def test_deploy_uptodate(mbed, testrepos):
+    test1 = testrepos[0]
+    popen(['python', mbed, 'import', test1, 'testimport'])
+
+    with cd('testimport'):
+        out = pquery(['python', mbed, 'deploy', '-v'])
+
+    assert 'is already at rev' in out
+    assert not re.search(r'Exec "(git (fetch|checkout)|hg (pull|update))', out)
@@ -0,0 +1,111 @@
+# Copyright (c) 2016 ARM Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+# You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.
+
+from util import *
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mbed import mbed as mbedcli
+
+URL = 'https://example.com/test1'
+
+# Runs network operations without waiting for the retries, and records their delays
+@pytest.fixture
+def delays(monkeypatch):
+    delays = []
+    monkeypatch.setattr(mbedcli, 'getretries', lambda: 2)
+    monkeypatch.setattr(mbedcli.time, 'sleep', delays.append)
+    return delays
+
+# Returns a function that fails the specified number of times before it succeeds
+def failing(failures):
+    calls = []
+    def func():
+        calls.append(len(calls))
+        if len(calls) <= failures:
+            raise mbedcli.ProcessException(128, "fetch failed")
+        return 'done'
+    return func, calls
+
+# Tests if failures are retried with increasing delays
+def test_transfers_retry(delays):
+    func, calls = failing(2)
+
+    assert mbedcli.Transfers().run(URL, func) == 'done'
+    assert len(calls) == 3
+    assert 0.5 <= delays[0] <= 1.5
+    assert 1.0 <= delays[1] <= 3.0
+
+# Tests if the last failure is raised when the retries are exhausted
+def test_transfers_retry_limit(delays):
+    func, calls = failing(10)
+
+    with pytest.raises(mbedcli.ProcessException):
+        mbedcli.Transfers().run(URL, func)
+    assert len(calls) == 3
+
+# Tests if local repositories aren't retried
+def test_transfers_local(delays):
+    func, calls = failing(10)
+
+    with pytest.raises(mbedcli.ProcessException):
+        mbedcli.Transfers().run('/tmp/test1', func)
+    assert len(calls) == 1
+
+# Tests if failures aren't retried once the parallel operation is cancelled
+def test_transfers_cancelled(delays, monkeypatch):
+    class Cancelled(object):
+        cancelled = True
+    monkeypatch.setattr(mbedcli.WorkQueue, 'current', classmethod(lambda cls: Cancelled()))
+    func, calls = failing(10)
+
+    with pytest.raises(mbedcli.ProcessException):
+        mbedcli.Transfers().run(URL, func)
+    assert len(calls) == 1
+
+# Tests if the concurrency limit of a host grows with successes and halves with failures
+def test_transfers_limit(delays):
+    transfers = mbedcli.Transfers()
+    for _ in range(8):
+        transfers.run(URL, lambda: None)
+    limit = transfers.hosts['example.com']['limit']
+    assert mbedcli.default_host_jobs < limit <= mbedcli.max_host_jobs
+
+    func, calls = failing(1)
+    transfers.run(URL, func)
+    assert transfers.hosts['example.com']['limit'] < limit / 2 + 1
+
+    for _ in range(4):
+        with pytest.raises(mbedcli.ProcessException):
+            transfers.run(URL, failing(10)[0])
+    assert transfers.hosts['example.com']['limit'] == 1.0
+
+# Tests if operations wait for a free slot of the host
+def test_transfers_slot():
+    transfers = mbedcli.Transfers()
+    transfers.hosts['example.com'] = {'limit': 1.0, 'active': 1}
+    entered = []
+    def operation():
+        with transfers.slot(URL):
+            entered.append(True)
+    thread = threading.Thread(target=operation)
+    thread.start()
+
+    time.sleep(0.2)
+    assert not entered
+    with transfers.cond:
+        transfers.hosts['example.com']['active'] -= 1
+        transfers.cond.notify_all()
+    thread.join(5)
+    assert entered
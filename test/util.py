@@ -60,6 +60,21 @@ def mbed(tmpdir):
 
     return MBED_PATH
     
+# Uses a repository cache (and mbed CLI configuration) of its own in the test directory
+@pytest.fixture
+def cache(mbed, tmpdir, monkeypatch):
+    home = str(tmpdir.mkdir('home'))
+    for f in ['.gitconfig', '.hgrc']:
+        if os.path.isfile(os.path.join(os.path.expanduser('~'), f)):
+            shutil.copy(os.path.join(os.path.expanduser('~'), f), home)
+    monkeypatch.setenv('HOME', home)
+    monkeypatch.setenv('USERPROFILE', home)
+    return os.path.join(home, '.mbed', 'mbed-cache')
+
+# Only repositories with a remote URL are cached, so the test repositories are used through file:// URLs
+def fileurl(path):
+    return 'file://localhost' + ('' if path.startswith('/') else '/') + path
+
 # Higher level functions
 def remove(path):
     def remove_readonly(func, path, _):